@@ -0,0 +1,154 @@
+from hashlib import md5
+from io import BytesIO
+from os import environ, lstat, readlink
+from pathlib import Path, PurePath
+from shutil import copyfileobj
+from stat import S_ISDIR, S_ISLNK, S_IMODE
+from tempfile import TemporaryFile
+from time import time
+import tarfile
+
+SCRIPTS = {'preinst', 'postinst', 'prerm', 'postrm', 'config'}
+
+
+class HashingReader:
+    def __init__(self, fp):
+        self.fp = fp
+        self.digest = md5()
+
+    def read(self, size=-1):
+        data = self.fp.read(size)
+        self.digest.update(data)
+        return data
+
+
+def normalise(data):
+    return data.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+
+
+def final_mode(info, mode):
+    return S_IMODE(info.st_mode) if mode is None else mode
+
+
+def epoch():
+    return int(environ.get('SOURCE_DATE_EPOCH', time()))
+
+
+def ar_member(out, name, size, mtime):
+    out.write(f'{name:<16}{mtime:<12}{0:<6}{0:<6}{"100644":<8}{size:<10}`\n'.encode('ASCII'))
+
+
+def tar_info(name, kind, mode, mtime, size=0, link=''):
+    info = tarfile.TarInfo('./' + name if name else './')
+    info.type = kind
+    info.mode = mode
+    info.mtime = mtime
+    info.size = size
+    info.linkname = link
+    info.uid = info.gid = 0
+    info.uname = info.gname = 'root'
+    return info
+
+
+def collect(root, streams):
+    # staged files win over streamed ones at the same path
+    entries = {
+        PurePath(remote).relative_to('/'): ('stream', source, mode, text)
+        for remote, (source, mode, text) in streams.items()
+    }
+
+    for path in Path(root).glob('**/*'):
+        relative = path.relative_to(root)
+        if relative.parts[0] != 'DEBIAN':
+            entries[relative] = ('staged', path, None, False)
+
+    return entries
+
+
+def write_data(spool, entries, mtime):
+    sums = []
+    folders = set()
+
+    with tarfile.open(fileobj=spool, mode='w|xz', format=tarfile.GNU_FORMAT) as tar:
+        tar.addfile(tar_info('', tarfile.DIRTYPE, 0o755, mtime))
+
+        for relative in sorted(entries, key=lambda path: path.parts):
+            kind, source, mode, text = entries[relative]
+            info = lstat(source)
+
+            # every parent needs its own entry before the children
+            for parent in reversed(relative.parents[:-1]):
+                if parent not in folders:
+                    folders.add(parent)
+                    tar.addfile(tar_info(f'{parent}/', tarfile.DIRTYPE, 0o755, mtime))
+
+            if S_ISDIR(info.st_mode):
+                if relative not in folders:
+                    folders.add(relative)
+                    tar.addfile(tar_info(f'{relative}/', tarfile.DIRTYPE, S_IMODE(info.st_mode), mtime))
+                continue
+
+            if S_ISLNK(info.st_mode):
+                tar.addfile(tar_info(str(relative), tarfile.SYMTYPE, 0o777, mtime, link=readlink(source)))
+                continue
+
+            mode = final_mode(info, mode)
+
+            if text:
+                # line endings change the size, so text files are normalised in memory first
+                with open(source, 'rb') as fp:
+                    data = normalise(fp.read())
+                tar.addfile(tar_info(str(relative), tarfile.REGTYPE, mode, mtime, len(data)), BytesIO(data))
+                sums.append(f'{md5(data).hexdigest()}  {relative}\n')
+                continue
+
+            with open(source, 'rb') as fp:
+                reader = HashingReader(fp)
+                tar.addfile(tar_info(str(relative), tarfile.REGTYPE, mode, mtime, info.st_size), reader)
+                sums.append(f'{reader.digest.hexdigest()}  {relative}\n')
+
+    return ''.join(sums)
+
+
+def write_control(root, sums, mtime):
+    buffer = BytesIO()
+
+    with tarfile.open(fileobj=buffer, mode='w:xz', format=tarfile.GNU_FORMAT) as tar:
+        tar.addfile(tar_info('', tarfile.DIRTYPE, 0o755, mtime))
+
+        members = {path.name: path.read_bytes() for path in sorted((Path(root) / 'DEBIAN').iterdir())}
+        members['md5sums'] = sums.encode('UTF8')
+
+        for name, data in sorted(members.items()):
+            mode = 0o755 if name in SCRIPTS else 0o644
+            tar.addfile(tar_info(name, tarfile.REGTYPE, mode, mtime, len(data)), BytesIO(data))
+
+    return buffer.getvalue()
+
+
+def build_deb(root, streams, output, mtime=None):
+    mtime = epoch() if mtime is None else mtime
+    entries = collect(root, streams)
+
+    # the compressed payload goes to a spool file, since ar needs its size up front
+    with TemporaryFile(dir=PurePath(output).parent) as spool:
+        sums = write_data(spool, entries, mtime)
+        size = spool.tell()
+        spool.seek(0)
+
+        control = write_control(root, sums, mtime)
+
+        with open(output, 'wb') as out:
+            out.write(b'!<arch>\n')
+
+            ar_member(out, 'debian-binary', 4, mtime)
+            out.write(b'2.0\n')
+
+            ar_member(out, 'control.tar.xz', len(control), mtime)
+            out.write(control + b'\n' * (len(control) % 2))
+
+            ar_member(out, 'data.tar.xz', size, mtime)
+            copyfileobj(spool, out)
+            out.write(b'\n' * (size % 2))
+
+    print(f"building package in '{output}' with {len(entries)} entries, {size} bytes of data")
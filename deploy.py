@@ -1,50 +1,148 @@
 #!/usr/bin/env python3
 import readline
 
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from os import listdir
 from git import Repo
-from os.path import exists, isdir
+from os.path import basename, exists, isdir
 from sys import argv
 from package import Package
 
+MODES = ('custom', 'changed', 'all')
+
+
+def find_packages(repo, mode, names):
+    selected = []
+
+    # Iterate over categories
+    for category in sorted(listdir()):
+        if not isdir(category):
+            continue
+
+        # Select all packages here unless named explicitly
+        for package in (names if mode == 'custom' else sorted(listdir(category))):
+            path = category + '/' + package
+            if exists(path + '/DEBIAN.YML'):
+                repo.git.add(path)
+                if mode in {'custom', 'all'} or repo.index.diff(repo.head.commit, paths=path):
+                    selected.append(path)
+
+    return selected
+
+
+def schedule(packages):
+    # Order packages into waves of mutually independent packages
+    names = {pkg.package.name for pkg in packages}
+    pending = {
+        pkg: (pkg.dependencies() & names) - {pkg.package.name}
+        for pkg in packages
+    }
+
+    waves = []
+    while pending:
+        wave = [pkg for pkg, depends in pending.items() if not depends]
+        if not wave:
+            raise ValueError('Circular dependencies between: ' + ', '.join(pkg.package.name for pkg in pending))
+
+        for pkg in wave:
+            del pending[pkg]
+        for depends in pending.values():
+            depends -= {pkg.package.name for pkg in wave}
+
+        waves.append(wave)
+
+    return waves
+
+
+def summarize(packages):
+    hosts = {}
+    modules = {}
+
+    for pkg in packages:
+        for target, timings in pkg.timings.items():
+            hosts.setdefault(target, []).extend(timings)
+            for timing in timings:
+                key = (pkg.package.name, timing['phase'], timing['module'])
+                modules.setdefault(key, []).append(timing['duration'])
+
+    print('Maintainer script time per host:')
+    for target, timings in sorted(hosts.items()):
+        failed = sum(1 for timing in timings if timing['status'])
+        print(f'  {target}: {sum(timing["duration"] for timing in timings):.1f}s in {len(timings)} snippets, {failed} failed')
+
+    print('Slowest modules across hosts:')
+    ranked = sorted(modules.items(), key=lambda item: sum(item[1]), reverse=True)
+    for (package, phase, module), durations in ranked[:10]:
+        print(f'  {package} {phase} {module}: {sum(durations):.1f}s total, {max(durations):.1f}s worst')
+
+
+def commit_message(args, pkg):
+    fields = {
+        'package': pkg.package.name,
+        'category': pkg.package.parent.name,
+        'version': pkg.version,
+    }
+
+    if args.message is not None:
+        return args.message.format(**fields)
+    if args.yes:
+        return 'Deploy {package} version {version}'.format(**fields)
+    return input(f'Enter Commit Message for "{pkg.package.name}": ')
+
+
 if __name__ == '__main__':
-    # Process file name
-    _, mode = argv[0].split('-')
-    assert mode in {'custom', 'changed', 'all'}
+    # Process arguments, defaulting the mode to the file name
+    name = basename(argv[0]).split('-')
+    parser = ArgumentParser(description='Build, deploy and commit packages in dependency order.')
+    parser.add_argument('packages', nargs='*', help='package names to deploy in custom mode')
+    parser.add_argument('--mode', choices=MODES, default=name[1] if len(name) == 2 and name[1] in MODES else None)
+    parser.add_argument('--yes', '-y', action='store_true', help='never prompt, use defaults instead')
+    parser.add_argument('--message', '-m', help='commit message template, may contain {package}, {category} and {version}')
+    parser.add_argument('--jobs', '-j', type=int, default=4, help='packages to build and deploy in parallel')
+    parser.add_argument('--no-push', action='store_true', help='do not push the commits to the remote')
+    parser.add_argument('--native', action='store_true', help='write archives directly instead of staging them for dpkg-deb')
+    parser.add_argument('--profile', action='store_true', help='time every maintainer script snippet and summarize per host')
+    args = parser.parse_args()
+
+    if args.mode is None:
+        parser.error('the following arguments are required: --mode')
 
     # Setup git repo
     repo = Repo()
     repo.git.reset()
 
     # Ask for package names when needed
-    if mode == 'custom':
-        packages = input('Enter Package Names: ').split(' ')
+    if args.mode == 'custom' and not args.packages:
+        if args.yes:
+            parser.error('custom mode requires package names when running with --yes')
+        args.packages = input('Enter Package Names: ').split(' ')
 
-    # Iterate over categories
-    for category in listdir():
-        if not isdir(category):
-            continue
+    # Build all selected packages
+    paths = {Package(path): path for path in find_packages(repo, args.mode, args.packages)}
+    for pkg in paths:
+        pkg.profile = args.profile
+        pkg.native = args.native
+    with ThreadPoolExecutor(args.jobs) as pool:
+        list(pool.map(Package.build, paths))
 
-        # Select all packages here otherwise
-        if mode != 'custom':
-            packages = listdir(category)
+    # Deploy and commit packages wave by wave
+    for wave in schedule(list(paths)):
+        if not args.yes:
+            input('Press ⏎ to Deploy ' + ', '.join(f'"{pkg.package.name}"' for pkg in wave) + ' ...')
 
-        # Iterate packages with changes
-        for package in packages:
-            if exists(category + '/' + package + '/DEBIAN.YML'):
-                repo.git.add(category + '/' + package)
+        with ThreadPoolExecutor(args.jobs) as pool:
+            list(pool.map(Package.deploy, wave))
 
-                # Build and deploy package
-                if mode in {'custom', 'all'} or repo.index.diff(repo.head.commit):
-                    input(f'Press ⏎ to Deploy "{package}" ...')
-                    pkg = Package(category + '/' + package)
-                    pkg.build()
-                    pkg.deploy()
+        for pkg in wave:
+            repo.git.add(paths[pkg])
+            if repo.index.diff(repo.head.commit, paths=paths[pkg]):
+                repo.git.commit('--message', commit_message(args, pkg), '--', paths[pkg])
 
-                # Commit changes to package
-                repo.git.add(category + '/' + package + '/version')
-                if repo.index.diff(repo.head.commit):
-                    repo.git.commit(message=input('Enter Commit Message: '))
+    # Show where install time went
+    if args.profile:
+        summarize(paths)
 
     # Push all changes to remote
-    repo.git.push()
+    if not args.no_push:
+        repo.git.push()
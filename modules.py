@@ -1,87 +1,196 @@
 from abc import ABC
+import re
 from shutil import copyfileobj, copystat
-import magic
 from itertools import chain, count
 from inspect import cleandoc, getfullargspec
-import requests
-from slugify import slugify
+from textwrap import indent
 from copy import deepcopy
 from pathlib import PurePath, Path
-from subprocess import run
+from subprocess import run, PIPE
 from contextlib import contextmanager
-from secrets import choice
-import gzip
+from hashlib import shake_256
 import json
+from zlib import crc32
+
+
+def slugify(*args, **kwargs):
+    from slugify import slugify
+    return slugify(*args, **kwargs)
 
 
 class ModuleScripts:
-    def __init__(self):
-        self.stages = {
-            'preinst': [],
-            'postinst': [],
-            'prerm': [],
-            'postrm': [],
-        }
-        self.prepares = []
-        self.triggers = []
+    PHASES = ('preinst', 'postinst', 'prerm', 'postrm')
+    STATEFUL = re.compile(
+        r'(?:^|[;&|(])\s*(?:(?:cd|pushd|popd|exit|return|export|unset|set|trap|shopt|source|umask|ulimit|exec|eval'
+        r'|declare|typeset|local|readonly|alias|shift|for|select|read|function)\b|\.\s|\w+=|[\w-]+\s*\(\s*\))',
+        re.M,
+    )
+
+    PROFILE = cleandoc("""
+        _start=$(date +%s%N)
+        set +e
+        (
+        {strict}{snippet}
+        )
+        _status=$?
+        _took=$(( $(date +%s%N) - _start ))
+        logger -t reversible "metric=maintainer-snippet {tag} phase={phase} module={module} snippet={index} status=$_status duration=$(( _took / 1000000000 )).$(printf %03d $(( _took / 1000000 % 1000 )))"
+    """)
+
+    def __init__(self, owner=None, stateless=False):
+        self.owner = owner
+        self.owners = {}
+        self.stateless = stateless
+        self.mergeable = set()
+        self.stages = {phase: [] for phase in self.PHASES}
+        self.prepares = {}
+        self.triggers = {}
         self.purges = []
 
+    def __iadd__(self, other):
+        for phase in self.PHASES:
+            self.stages[phase] += other.stages[phase]
+
+        self.purges += other.purges
+        self.prepares.update(other.prepares)
+        self.triggers.update(other.triggers)
+        for script, owner in other.owners.items():
+            self.owners.setdefault(script, owner)
+        self.mergeable |= other.mergeable
+
+        return self
+
     def __add__(self, other):
         result = ModuleScripts()
+        result += self
+        result += other
+        return result
 
-        for mode in ('preinst', 'postinst', 'prerm', 'postrm'):
-            result.stages[mode] += self.stages[mode]
-            result.stages[mode] += other.stages[mode]
+    def own(self, script):
+        self.owners.setdefault(script, self.owner)
+        if self.stateless:
+            self.mergeable.add(script)
+        return script
 
-        result.purges += self.purges
-        result.purges += other.purges
+    def merges(self, snippet):
+        # only generated snippets are trusted to share a subshell, and only when they look harmless
+        return snippet in self.mergeable and not self.STATEFUL.search(snippet)
 
-        for script in chain(self.prepares, other.prepares):
-            if script not in result.prepares:
-                result.prepares.append(script)
+    def group(self, snippets):
+        groups = []
 
-        for script in chain(self.triggers, other.triggers):
-            if script not in result.triggers:
-                result.triggers.append(script)
+        for snippet in snippets:
+            if groups and self.merges(snippet) and self.merges(groups[-1][-1]):
+                groups[-1].append(snippet)
+            else:
+                groups.append([snippet])
 
-        return result
+        return groups
+
+    def assemble(self, phase, profile=None):
+        content = []
+
+        if phase in {'postinst', 'postrm'}:
+            content += self.prepares
+        content += self.stages[phase]
+        if phase in {'postinst', 'postrm'}:
+            content += self.triggers
+
+        purges = self.purges if phase == 'postrm' else []
+        if not content and not purges:
+            return None, 0, 0
+
+        # profiled scripts time every snippet on its own
+        if profile is None:
+            groups = self.group(content)
+            purged = self.group(purges)
+        else:
+            groups = [[self.profile(snippet, phase, profile, i)] for i, snippet in enumerate(content)]
+            purged = [[self.profile(snippet, phase, profile, i)] for i, snippet in enumerate(purges, len(content))]
+
+        text = '#!/bin/bash'
+
+        if phase in {'preinst', 'prerm'}:
+            text += '\nset -e'
+
+        if purges:
+            text += '\n\nif [[ "$1" == "purge" ]]; then'
+            text += self.subshells(purged, profile is not None)
+            text += '\n\nexit 0; fi'
+
+        text += self.subshells(groups, profile is not None)
+        text += '\n\nexit 0\n'
+
+        return text, len(content) + len(purges), len(groups) + len(purged)
+
+    def profile(self, snippet, phase, tag, index):
+        strict = 'set -e\n' if phase in {'preinst', 'prerm'} else ''
+        text = self.PROFILE.format(
+            strict=strict, snippet=snippet, tag=tag, phase=phase,
+            module=self.owners.get(snippet) or 'unknown', index=index,
+        )
+
+        # keep failing snippets fatal where the script is strict
+        if strict:
+            text += '\nset -e\n(exit $_status)'
+
+        return text
+
+    @staticmethod
+    def subshells(groups, bare=False):
+        if bare:
+            return ''.join('\n\n' + '\n'.join(group) for group in groups)
+        return ''.join('\n\n(\n' + '\n'.join(group) + '\n)' for group in groups)
 
     def prepare(self, script):
-        self.prepares.append(script)
+        self.prepares[self.own(script)] = None
 
     def trigger(self, script):
-        self.triggers.append(script)
+        self.triggers[self.own(script)] = None
 
     def purge(self, script):
-        self.purges.append(script)
+        self.purges.append(self.own(script))
 
     def install(self, script, undo=None, *_, when='before'):
         if when == 'before':
-            self.stages['preinst'].append(script)
+            self.stages['preinst'].append(self.own(script))
             if undo:
-                self.stages['postrm'].append(undo)
+                self.stages['postrm'].append(self.own(undo))
         if when == 'after':
-            self.stages['postinst'].append(script)
+            self.stages['postinst'].append(self.own(script))
             if undo:
-                self.stages['prerm'].append(undo)
+                self.stages['prerm'].append(self.own(undo))
 
     def remove(self, script, *_, when='before'):
         if when == 'before':
-            self.stages['prerm'].append(script)
+            self.stages['prerm'].append(self.own(script))
         if when == 'after':
-            self.stages['postrm'].append(script)
+            self.stages['postrm'].append(self.own(script))
 
 
 class BaseModule(ABC):
     YAML = {'DEBIAN.YML', '**/.git.yml'}
-    LISTENERS = []
+    LISTENERS = {}
+    STREAMS = {}
+    DEBOUNCE = '15s'
+    STATELESS = False
+    MAINTENANCE = {
+        'nice': 10,
+        'io-class': 'idle',
+        'cpu-quota': None,
+        'memory-max': None,
+        'delay': '1h',
+        'jobs': 2,
+    }
+    DEFAULTS = {}
 
     def __init__(self, source, target):
         self.source = source
         self.target = target
         self.control = {}
-        self.scripts = ModuleScripts()
-        self.LISTENERS.append(self.on_file_write)
+        self.scripts = ModuleScripts(type(self).__name__, self.STATELESS)
+        self.overrides = {}
+        self.LISTENERS.setdefault(target, []).append(self.on_file_write)
 
     def process_yaml(self, path, content):
         for i in count(1):
@@ -106,6 +215,9 @@ class BaseModule(ABC):
     def on_file_write(self, remote, local):
         pass
 
+    def finalize(self):
+        pass
+
     @contextmanager
     def prepare(self, absolute, mode=None, like=None):
         absolute = PurePath(absolute)
@@ -126,9 +238,18 @@ class BaseModule(ABC):
         elif mode is not None:
             raise NotImplementedError('Tried to set permissions on symlink!')
 
-        for handler in self.LISTENERS:
+        for handler in self.LISTENERS[self.target]:
             handler(absolute, output)
 
+    def stream(self, absolute, mode, like, text):
+        absolute = PurePath(absolute)
+        source = self.source / PurePath(like).relative_to('/')
+
+        # the archive writer reads the source itself, listeners get to see it there
+        self.STREAMS[self.target][absolute] = (source, mode, text)
+        for handler in self.LISTENERS[self.target]:
+            handler(absolute, source)
+
     @contextmanager
     def write(self, absolute, executable):
         with self.prepare(absolute, 0o755 if executable else 0o644) as output:
@@ -136,37 +257,116 @@ class BaseModule(ABC):
                 yield fp
 
     def systemd_reload(self, unit):
-        self.scripts.trigger(f'systemctl try-reload-or-restart {unit}')
+        self.debounce('try-reload-or-restart', unit)
+
+    def debounce(self, action, unit):
+        self.deferred('reversible-' + slugify(f'{action} {unit}'), f'systemctl {action} {unit}')
+
+    def deferred(self, timer, command):
+        self.scripts.trigger(cleandoc(f"""
+            systemctl restart "{timer}.timer" 2> /dev/null || \\
+                systemd-run --quiet --collect --unit="{timer}" --on-active={self.DEBOUNCE} {command} || \\
+                {command}
+        """))
+
+    def maintenance(self):
+        # the build hands over the repository and category settings, the package adds its own
+        settings = {**self.MAINTENANCE, **self.DEFAULTS.get(self.target, {}), **self.overrides}
+
+        if int(settings['jobs']) < 1:
+            raise ValueError(f'Package "{self.source.name}" allows {settings["jobs"]} maintenance jobs, at least 1 is needed!')
+
+        return settings
+
+    def timer(self, unit, description, calendar, commands, **options):
+        settings = self.maintenance()
+
+        with self.write(f'/lib/systemd/system/{unit}.timer', False) as fp:
+            fp.write(cleandoc(f"""
+                [Unit]
+                Description={description}
+                [Timer]
+                OnCalendar={calendar}
+                Persistent=true
+                RandomizedDelaySec={settings['delay']}
+                FixedRandomDelay=true
+                [Install]
+                WantedBy=timers.target
+            """))
+
+        limits = {
+            'Nice': settings['nice'],
+            'IOSchedulingClass': settings['io-class'],
+            'CPUQuota': settings['cpu-quota'],
+            'MemoryMax': settings['memory-max'],
+        }
+
+        # jobs sharing a slot run one after another, bounding how many run at once
+        lock = f'/run/reversible/maintenance-{crc32(unit.encode()) % settings["jobs"]}.lock'
+
+        with self.write(f'/lib/systemd/system/{unit}.service', False) as fp:
+            fp.write(cleandoc(f"""
+                [Unit]
+                Description={description}
+                [Service]
+                Type=oneshot
+            """))
+            for key, value in chain(options.items(), limits.items()):
+                if value is not None:
+                    fp.write(f'\n{key}={value}')
+
+            # root creates the lock, so units running as other users can open it but never own it
+            fp.write('\nExecStartPre=+/usr/bin/mkdir -p /run/reversible')
+            fp.write(f'\nExecStartPre=+/usr/bin/touch {lock}')
+            for command in commands:
+                fp.write(f'\nExecStart=/usr/bin/flock {lock} {command}')
 
     @staticmethod
-    def token(size):
+    def token(size, *seeds):
         alphabet = '0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
-        return ''.join(choice(alphabet) for _ in range(size))
+        digest = shake_256('\0'.join(str(seed) for seed in seeds).encode('UTF8')).digest(size)
+        return ''.join(alphabet[byte % len(alphabet)] for byte in digest)
 
     def snippet_file(self, script, *args):
         local = Path(__file__).parent / 'scripts' / script
-        remote = PurePath('/usr/bin/') / self.token(20)
 
         with open(local, 'rb') as fp1:
-            with self.prepare(remote, 0o755) as path:
-                with open(path, 'wb') as fp2:
-                    copyfileobj(fp1, fp2)
+            content = fp1.read()
+
+        # the same helper in the same package always lands at the same place
+        remote = PurePath('/usr/bin/') / self.token(20, self.source.name, script, content)
+
+        with self.prepare(remote, 0o755) as path:
+            with open(path, 'wb') as fp2:
+                fp2.write(content)
 
         return str(remote) + ''.join(f' "{arg}"' for arg in args)
 
-    def snippet_inline(self, script, *args):
-        tag = '_' + self.token(20)
-        text = ''
+    def snippet_copy(self, script, remote):
+        with open(Path(__file__).parent / 'scripts' / script, 'r') as fp:
+            content = fp.read().strip()
+
+        tag = '_' + self.token(20, content)
 
-        text += f'{tag}=`cat << {tag}\n'
+        return f'mkdir -p "{PurePath(remote).parent}"\ncat > "{remote}" << \'{tag}\'\n{content}\n{tag}'
 
+    def snippet_inline(self, script, *args, stdin=None):
         with open(Path(__file__).parent / 'scripts' / script, 'r') as fp:
-            text += fp.read().strip() + '\n'
+            content = fp.read().strip()
 
-        text += f'{tag}`\n'
-        text += f'python3 -c "${tag}"'
+        tag = '_' + self.token(20, content, *args, stdin)
+        text = f"{tag}=$(cat << '{tag}'\n{content}\n{tag}\n)"
+
+        # the shell has to hand the script over untouched, whatever it contains
+        result = run(('bash', '-c', f'{text}\nprintf %s "${tag}"'), stdout=PIPE, check=True)
+        if result.stdout.decode('UTF8') != content:
+            raise ValueError(f'Script "{script}" does not survive inlining!')
+
+        text += f'\npython3 -c "${tag}"'
         for arg in args:
             text += f' "{arg}"'
+        if stdin is not None:
+            text += f" << '{tag}'\n{stdin}\n{tag}"
 
         return text
 
@@ -191,13 +391,14 @@ class ControlFile(BaseModule):
 
 
 class SecureFiles(BaseModule):
+    STATELESS = True
+
     def _parse_debian_yml_1(self, _, secure):
-        for user, paths in secure.items():
-            for path in paths:
-                self.scripts.install(cleandoc(f"""
-                    chmod -077 "{path}"
-                    chown {user}:{user} "{path}"
-                """), False, when='after')
+        manifest = [f'secure {user} {path}' for user, paths in secure.items() for path in paths]
+        self.scripts.install(
+            self.snippet_inline('apply-permissions.py', stdin='\n'.join(manifest)),
+            False, when='after',
+        )
 
 
 class CopyFiles(BaseModule):
@@ -212,6 +413,7 @@ class CopyFiles(BaseModule):
         # determine some file properties
         shebang = fp.read(3)
         if len(shebang) == 3:
+            import magic
             mime = magic.from_buffer(shebang + fp.read(1048573), True).split('/')[0]
         else:
             mime = None
@@ -223,6 +425,11 @@ class CopyFiles(BaseModule):
         if str(path) in self.secure:
             mode &= 0o700
 
+        # leave the copying to the archive writer when it reads sources directly
+        if self.target in self.STREAMS:
+            self.stream(path, mode, path, mime == 'text')
+            return
+
         # reset file pointer
         fp.seek(0)
 
@@ -241,104 +448,122 @@ class CopyFiles(BaseModule):
 
 
 class PackageManagers(BaseModule):
-    def _parse_debian_yml_1(self, _, pip, npm):
-        with self.write(f'/lib/systemd/system/{self.source.name}.timer', False) as fp:
-            fp.write(cleandoc(f"""
-                [Unit]
-                Description=update process for Python/Node packages of "{self.source.name}"
-                [Timer]
-                OnCalendar=daily
-                Persistent=true
-                RandomizedDelaySec=1h
-                [Install]
-                WantedBy=timers.target
-            """))
+    STATELESS = True
+    VENVS = PurePath('/var/lib/reversible/venvs/')
 
-        with self.write(f'/lib/systemd/system/{self.source.name}.service', False) as fp:
-            fp.write(cleandoc(f"""
-                [Unit]
-                Description=update process for Python/Node packages of "{self.source.name}"
-                [Service]
-                Type=oneshot
-            """))
-            if pip is not None:
-                fp.write('\nExecStart=/usr/bin/pip3 install --upgrade ' + ' '.join(pip))
-            if npm is not None:
-                fp.write('\nExecStart=/usr/bin/npm install --global --production ' +
-                         ' '.join(item + '@latest' for item in npm))
+    def _parse_debian_yml_1(self, _, maintenance):
+        self.overrides = maintenance
+
+    def _parse_debian_yml_2(self, _, pip, npm, virtualenv):
+        args = []
+        if pip is not None:
+            args += ['--pip', *pip]
+        if npm is not None:
+            args += ['--npm', *npm]
+        if virtualenv:
+            args += ['--venv', self.VENVS / self.source.name]
+            self.scripts.purge(f'rm -rf "{self.VENVS / self.source.name}"')
+
+        self.timer(
+            self.source.name, f'update process for Python/Node packages of "{self.source.name}"',
+            'daily', [self.snippet_file('upgrade-packages.py', *args)],
+        )
 
         self.scripts.install(
-            f'systemctl start {self.source.name}.service',
+            f'systemctl start --no-block {self.source.name}.service',
             False, when='after',
         )
 
         self.control['pre-depends'] = []
         if pip is not None:
             self.control['pre-depends'].append('python3-pip')
+        if pip is not None and virtualenv:
+            self.control['pre-depends'].append('python3-venv')
         if npm is not None:
             self.control['pre-depends'].append('npm')
 
 
 class OpenPorts(BaseModule):
+    STATELESS = True
+    SYNC = PurePath('/usr/local/lib/reversible/upnp-ports.py')
+
+    NETWORKS = ('192.168.0.0/16', 'fe80::/10', '172.16.0.0/12', '2001:db8:1::/64')
+
+    def profile(self, category, ports):
+        name = f'{self.source.name}-{category}'
+
+        with self.write(f'/etc/ufw/applications.d/{name}', False) as fp:
+            fp.write(cleandoc(f"""
+                [{name}]
+                title={category.title()} ports of {self.source.name}
+                description=Ports opened by the {self.source.name} package.
+                ports={'|'.join(str(port) for port in ports)}
+            """) + '\n')
+
+        return name
+
+    def rules(self, rules):
+        self.scripts.install(
+            '\n'.join(f'ufw {rule} > /dev/null' for rule in rules),
+            '\n'.join(f'ufw delete {rule} > /dev/null' for rule in rules),
+            when='after',
+        )
+
     def _parse_debian_yml_1(self, _, firewall):
         self.control['pre-depends'] = []
 
         if 'block' in firewall:
             self.control['pre-depends'] += ['ufw']
-            for port in firewall['block']:
-                self.scripts.install(f'ufw deny out {port}', f'ufw delete deny out {port}')
+            name = self.profile('blocked', firewall['block'])
+            self.rules([f'deny out to any app {name}'])
 
         if 'internal' in firewall:
             self.control['pre-depends'] += ['ufw']
-            for port in firewall['internal']:
-                self.scripts.install(cleandoc(f"""
-                    ufw allow from 192.168.0.0/16 to any port {port}
-                    ufw allow from fe80::/10 to any port {port}
-                    ufw allow from 172.16.0.0/12 to any port {port}
-                    ufw allow from 2001:db8:1::/64 to any port {port}
-                """), cleandoc(f"""
-                    ufw delete allow from 192.168.0.0/16 to any port {port}
-                    ufw delete allow from fe80::/10 to any port {port}
-                    ufw delete allow from 172.16.0.0/12 to any port {port}
-                    ufw delete allow from 2001:db8:1::/64 to any port {port}
-                """))
+            name = self.profile('internal', firewall['internal'])
+            self.rules([f'allow from {network} to any app {name}' for network in self.NETWORKS])
 
         if 'external' in firewall:
-            self.control['pre-depends'] += ['ufw', 'miniupnpc']
+            self.control['pre-depends'] += ['ufw', 'python3']
+            gateway = firewall.get('gateway', '192.168.68.1')
+            name = self.profile('external', firewall['external'])
+            self.rules([f'allow to any app {name}'])
 
-            for port in firewall['external']:
-                self.scripts.install(
-                    f'ufw allow {port}',
-                    f'ufw delete allow {port}',
-                )
+            with self.write(f'/etc/upnp/ports/{self.source.name}.json', False) as fp:
+                json.dump({'address': firewall.get('address'), 'ports': firewall['external']}, fp)
 
             with self.write(f'/etc/cron.d/{self.source.name}', False) as fp:
-                for port in firewall['external']:
-                    enable = (
-                        f'upnpc -i -z {{}} -a 192.168.68.105 {port} {port} tcp || true',
-                        f'upnpc -i -z {{}} -a 192.168.68.105 {port} {port} udp || true',
-                    )
-                    disable = (
-                        f'upnpc -i -z {{}} -d {port} tcp || true',
-                        f'upnpc -i -z {{}} -d {port} udp || true',
-                    )
-
-                    for code in enable:
-                        fp.write(f'*/10 * * * * root ' + code.format(1900) + ' &> /dev/null' + '\n')
-
-                    self.scripts.install(*[
-                        '\n'.join(chain(
-                            ['ufw allow from 192.168.68.1 to any port 1901'],
-                            [code.format(1901) for code in action],
-                            ['ufw delete allow from 192.168.68.1 to any port 1901'],
-                        )) for action in (enable, disable)
-                    ], when='before')
+                fp.write(f'*/10 * * * * root /usr/bin/python3 {self.SYNC} --interval 540 > /dev/null 2>&1\n')
+
+            # map or unmap the ports right away, the mappings of other packages are left alone,
+            # and the helper goes away once the last package with external ports is removed
+            self.scripts.trigger(self.snippet_copy('upnp-ports.py', self.SYNC))
+            self.scripts.trigger(cleandoc(f"""
+                ufw allow from {gateway} to any port 1901 > /dev/null
+                /usr/bin/python3 {self.SYNC} --ssdp-port 1901 || true
+                ufw delete allow from {gateway} to any port 1901 > /dev/null
+                if [ ! -d /etc/upnp/ports ]; then
+                    rm -f "{self.SYNC}"
+                fi
+            """))
 
 
 class DNS(BaseModule):
+    STATELESS = True
+    SYNC = PurePath('/usr/local/lib/reversible/cloudflare-sync.py')
+    CONFIG = PurePath('/etc/cloudflare/sync.json')
+
     def on_file_write(self, path, _):
-        if path.parent in {PurePath('/etc/nginx/sites-enabled/'), PurePath('/etc/cloudflare/records/')}:
-            self.scripts.trigger('systemctl restart ddns.service')
+        if path.parent == PurePath('/etc/nginx/sites-enabled/'):
+            self.debounce('restart', 'ddns.service')
+        if path.parent == PurePath('/etc/cloudflare/records/'):
+            # hosts without a sync configuration keep publishing their records through ddns,
+            # and the helper goes away after the run that follows the removal of the last record file
+            self.scripts.trigger(self.snippet_copy('cloudflare-sync.py', self.SYNC))
+            self.deferred('reversible-cloudflare-sync', (
+                f"/bin/sh -c 'if [ -e {self.CONFIG} ]; then /usr/bin/python3 {self.SYNC}; "
+                f"else systemctl restart ddns.service; fi; "
+                f"[ -d {path.parent} ] || rm -f {self.SYNC}'"
+            ))
 
     def _parse_debian_yml_1(self, _, cloudflare):
         with self.write(f'/etc/cloudflare/records/{self.source.name}.json', False) as fp:
@@ -346,6 +571,92 @@ class DNS(BaseModule):
 
 
 class ReverseProxy(BaseModule):
+    STATELESS = True
+    SERVER = 'server {address}:{port}{options};'
+
+    BALANCE = {
+        'round-robin': None,
+        'least-conn': 'least_conn;',
+        'ip-hash': 'ip_hash;',
+        'random': 'random;',
+    }
+
+    CACHE_PATH = cleandoc("""
+        proxy_cache_path /var/cache/nginx/{name} levels=1:2 keys_zone={name}:10m max_size={size} inactive={ttl} use_temp_path=off;
+    """)
+
+    CACHE = cleandoc("""
+        proxy_cache {name};
+        proxy_cache_valid 200 301 302 {ttl};
+        proxy_cache_use_stale error timeout updating http_500 http_502 http_503 http_504;
+        proxy_cache_background_update on;
+        proxy_cache_lock on;
+        more_set_headers "X-Cache-Status: $upstream_cache_status";
+    """)
+
+    OPEN_FILE_CACHE = cleandoc("""
+        open_file_cache max={max} inactive={inactive};
+        open_file_cache_valid {valid};
+        open_file_cache_min_uses 2;
+        open_file_cache_errors on;
+    """)
+
+    LOGGING = cleandoc("""
+        error_log /var/log/nginx/{name}.error.log;
+        access_log /var/log/nginx/{name}.access.log;
+    """)
+
+    TIMEOUTS = cleandoc("""
+        proxy_read_timeout {timeout};
+        proxy_send_timeout {timeout};
+    """)
+
+    REDIRECT = cleandoc("""
+        location = {from} {{
+            return {code} {to};
+        }}
+    """)
+
+    FASTCGI = cleandoc("""
+        fastcgi_pass {backend};
+        include /etc/nginx/fastcgi_params;
+        fastcgi_param SCRIPT_FILENAME "{php}";
+    """)
+
+    @classmethod
+    def balance(cls, method):
+        if method.startswith('hash '):
+            return method + ';'
+        return cls.BALANCE[method]
+
+    @classmethod
+    def server(cls, proxy, server):
+        options = ''
+
+        if 'weight' in server:
+            options += f' weight={server["weight"]}'
+        if 'max-fails' in server or 'max-fails' in proxy:
+            options += f' max_fails={server.get("max-fails", proxy.get("max-fails"))}'
+        if 'fail-timeout' in server or 'fail-timeout' in proxy:
+            options += f' fail_timeout={server.get("fail-timeout", proxy.get("fail-timeout"))}'
+        if server.get('backup', False):
+            options += ' backup'
+
+        port = server.get('port', proxy.get('port'))
+        if port is None:
+            raise ValueError(f'Backend of proxy "{proxy["name"]}" has no port!')
+
+        return cls.SERVER.format(
+            address=server.get('address', proxy['address']),
+            port=port,
+            options=options,
+        )
+
+    @staticmethod
+    def block(header, *groups):
+        body = '\n\n'.join(group for group in groups if group)
+        return header + ' {\n' + indent(body, '    ') + '\n}'
+
     def _parse_debian_yml_1(self, _, proxies):
         self.systemd_reload('nginx.service')
 
@@ -379,76 +690,99 @@ class ReverseProxy(BaseModule):
                     'Cross-Origin-Resource-Policy: same-origin',
                 ]
 
-            with self.write('/etc/nginx/sites-available/' + proxy['name'] + '.conf', False) as fp:
-                fp.write('server {\n')
-                for include in includes:
-                    fp.write(f'    include /etc/nginx/snippets/{include}.conf;\n')
-                if includes:
-                    fp.write('\n')
-
-                fp.write('    server_name ' + ' '.join(proxy['domains']) + ';\n')
-                if proxy['logging']:
-                    fp.write('    error_log /var/log/nginx/' + proxy['name'] + '.error.log;\n')
-                    fp.write('    access_log /var/log/nginx/' + proxy['name'] + '.access.log;\n')
-                else:
-                    fp.write('    error_log /dev/null;\n')
-                    fp.write('    access_log /dev/null;\n')
-                fp.write('\n')
+            # directives outside of the server block
+            http = []
+
+            if 'keepalive' in proxy or 'backends' in proxy:
+                backend = proxy['name'] + '_backend'
+                http.append(self.block(
+                    'upstream ' + backend,
+                    self.balance(proxy.get('balance', 'round-robin')),
+                    '\n'.join(self.server(proxy, server) for server in proxy.get('backends', [{}])),
+                    f'keepalive {proxy["keepalive"]};' if 'keepalive' in proxy else None,
+                ))
+            elif 'port' in proxy:
+                backend = proxy['address'] + ':' + str(proxy['port'])
+            else:
+                raise ValueError(f'Proxy "{proxy["name"]}" has neither a port nor backends!')
 
-                fp.write(f'    proxy_read_timeout {timeout};\n')
-                fp.write(f'    proxy_send_timeout {timeout};\n')
-                fp.write('\n')
+            if 'cache' in proxy:
+                cache = {'name': proxy['name'] + '_cache', 'size': '1g', 'ttl': '10m'}
+                cache.update(proxy['cache'])
+                http.append(self.CACHE_PATH.format(**cache))
 
-                for header in proxy['headers']:
-                    fp.write(f'    more_set_headers "{header}";\n')
-                if proxy['headers']:
-                    fp.write('\n')
-
-                for redirect in proxy['redirects']:
-                    fp.write('    location = ' + redirect['from'] + ' {\n')
-                    fp.write('        return ' + (
-                        '308' if redirect['permanent'] else '307'
-                    ) + ' ' + redirect['to'] + ';\n')
-                    fp.write('    }\n')
-                    fp.write('\n')
-
-                for static in proxy['static']:
-                    fp.write('    location ' + static['location'] + ' {\n')
-                    if 'root' in static:
-                        fp.write('        root "' + static['root'] + '";\n')
-                    if 'alias' in static:
-                        fp.write('        alias "' + static['alias'] + '";\n')
-                    if 'expires' in static:
-                        fp.write('        expires ' + static['expires'] + ';\n')
-                    fp.write('    }\n')
-                    fp.write('\n')
-
-                fp.write('    location / {\n')
-                if 'root' in proxy:
-                    if 'expires' in proxy:
-                        fp.write('        expires ' + proxy['expires'] + ';\n')
-                    fp.write('        root "' + proxy['root'] + '";\n')
-                    fp.write('        try_files $uri @proxy;\n')
-                    fp.write('    }\n')
-                    fp.write('\n')
-
-                    fp.write('    location @proxy {\n')
-                if 'php' in proxy:
-                    fp.write('        fastcgi_pass ' + proxy['address'] + ':' + str(proxy['port']) + ';\n')
-                    fp.write('        include /etc/nginx/fastcgi_params;\n')
-                    fp.write('        fastcgi_param SCRIPT_FILENAME "' + proxy['php'] + '";\n')
-                else:
-                    fp.write('        proxy_pass http://' + proxy['address'] + ':' + str(proxy['port']) + ';\n')
-                fp.write('    }\n')
+            # directives for the backend location
+            upstream = []
+
+            if 'php' in proxy:
+                upstream.append(self.FASTCGI.format(backend=backend, php=proxy['php']))
+                if 'keepalive' in proxy:
+                    upstream.append('fastcgi_keep_conn on;')
+            else:
+                upstream.append(f'proxy_pass http://{backend};')
+                if 'keepalive' in proxy:
+                    upstream.append('proxy_http_version 1.1;\nproxy_set_header Connection "";')
+                if 'buffering' in proxy:
+                    upstream.append('proxy_buffering ' + ('on' if proxy['buffering'] else 'off') + ';')
+                if 'cache' in proxy:
+                    upstream.append(self.CACHE.format(**cache))
+
+            # locations in order of precedence
+            locations = []
+
+            for redirect in proxy['redirects']:
+                locations.append(self.REDIRECT.format(code='308' if redirect['permanent'] else '307', **redirect))
+
+            for static in proxy['static']:
+                directives = []
+                if 'root' in static:
+                    directives.append('root "' + static['root'] + '";')
+                if 'alias' in static:
+                    directives.append('alias "' + static['alias'] + '";')
+                if 'expires' in static:
+                    directives.append('expires ' + static['expires'] + ';')
+                if static.get('gzip-static', False):
+                    directives.append('gzip_static on;')
+                if static.get('brotli-static', False):
+                    directives.append('brotli_static on;')
+                locations.append(self.block('location ' + static['location'], '\n'.join(directives)))
+
+            if 'root' in proxy:
+                directives = []
+                if 'expires' in proxy:
+                    directives.append('expires ' + proxy['expires'] + ';')
+                directives.append('root "' + proxy['root'] + '";')
+                directives.append('try_files $uri @proxy;')
+                locations.append(self.block('location /', '\n'.join(directives)))
+                locations.append(self.block('location @proxy', '\n'.join(upstream)))
+            else:
+                locations.append(self.block('location /', '\n'.join(upstream)))
+
+            server = self.block(
+                'server',
+                '\n'.join(f'include /etc/nginx/snippets/{include}.conf;' for include in includes),
+                '\n'.join([
+                    'server_name ' + ' '.join(proxy['domains']) + ';',
+                    self.LOGGING.format(**proxy) if proxy['logging'] else 'error_log /dev/null;\naccess_log /dev/null;',
+                ]),
+                self.TIMEOUTS.format(timeout=timeout),
+                self.OPEN_FILE_CACHE.format(**{
+                    'max': 1000, 'inactive': '60s', 'valid': '30s', **proxy['open-file-cache'],
+                }) if 'open-file-cache' in proxy else None,
+                '\n'.join(f'more_set_headers "{header}";' for header in proxy['headers']),
+                *locations,
+            )
 
-                # end of nginx file
-                fp.write('}\n')
+            with self.write('/etc/nginx/sites-available/' + proxy['name'] + '.conf', False) as fp:
+                fp.write('\n\n'.join(http + [server]) + '\n')
 
             with self.prepare('/etc/nginx/sites-enabled/' + proxy['name'] + '.conf') as enabled:
                 enabled.symlink_to('../sites-available/' + proxy['name'] + '.conf')
 
 
 class WebSites(BaseModule):
+    STATELESS = True
+
     def on_file_write(self, path, _):
         if path.parent == PurePath('/etc/nginx/sites-enabled/'):
             self.systemd_reload('nginx.service')
@@ -457,15 +791,24 @@ class WebSites(BaseModule):
 
 
 class SharedFolders(BaseModule):
+    STATELESS = True
+
+    def __init__(self, source, target):
+        super().__init__(source, target)
+        self.manifest = []
+
+    def finalize(self):
+        if self.manifest:
+            self.scripts.install(
+                self.snippet_inline('apply-permissions.py', stdin='\n'.join(self.manifest)),
+                False, when='before',
+            )
+
     def _manage_local_folder(self, owner, folder):
         parent = PurePath(folder).parent
 
-        self.scripts.install(cleandoc(f"""
-            mkdir -p "{folder}"
-            chown {owner}:{owner} "{folder}"
-        """), cleandoc(f"""
-            rmdir -p "{folder}"
-        """), when='before')
+        self.manifest.append(f'folder {owner} {folder}')
+        self.scripts.remove(f'rmdir -p "{folder}"', when='after')
 
         self.scripts.purge(cleandoc(f"""
             if [ -e "{folder}" ]; then
@@ -536,6 +879,7 @@ class AptSources(BaseModule):
 
                     for key in keys:
                         if key.startswith('http://') or key.startswith('https://'):
+                            import requests
                             run(base + ('adv', '--import'), input=requests.get(key).content)
                         elif key.startswith('hkp://'):
                             server, kid = key.rsplit('/', 1)
@@ -554,6 +898,8 @@ class Triggers(BaseModule):
 
 
 class SystemdUnits0(BaseModule):
+    STATELESS = True
+
     def manage(self, unit):
         self.scripts.install(cleandoc(f"""
             systemctl enable "{unit}"
@@ -599,89 +945,111 @@ class SystemdUnits2(SystemdUnits0):
 
 
 class ManageDBs(BaseModule):
+    STATELESS = True
+    SECRET = '@SECRET@'
+
+    CLIENTS = {
+        'mysql': 'mysql',
+        'psql': 'sudo -u postgres psql --quiet',
+        'mongosh': 'mongosh --quiet',
+    }
+
+    MYSQL = {
+        'install': cleandoc("""
+            CREATE DATABASE IF NOT EXISTS {name};
+            CREATE USER IF NOT EXISTS {name} IDENTIFIED BY '{secret}';
+            GRANT ALL PRIVILEGES ON {name}.* TO {name};
+            ALTER USER {name} IDENTIFIED BY '{password}';
+        """),
+        'undo': cleandoc("""
+            ALTER USER {name} IDENTIFIED BY '{secret}';
+        """),
+        'purge': cleandoc("""
+            DROP DATABASE IF EXISTS {name};
+            DROP USER IF EXISTS {name};
+        """),
+    }
+
+    PSQL = {
+        'install': cleandoc("""
+            SELECT 'CREATE DATABASE {name}' WHERE NOT EXISTS (SELECT FROM pg_database WHERE datname = '{name}')\\gexec
+            SELECT format('CREATE USER {name} WITH PASSWORD %L', '{secret}') WHERE NOT EXISTS (SELECT FROM pg_roles WHERE rolname = '{name}')\\gexec
+            ALTER DATABASE {name} OWNER TO {name};
+            ALTER USER {name} WITH PASSWORD '{password}';
+        """),
+        'undo': cleandoc("""
+            ALTER USER {name} WITH PASSWORD '{secret}';
+        """),
+        'purge': cleandoc("""
+            DROP DATABASE IF EXISTS {name} WITH (FORCE);
+            DROP USER IF EXISTS {name};
+        """),
+    }
+
+    MONGOSH = {
+        'install': cleandoc("""
+            database = db.getSiblingDB('{name}');
+            if (!database.getUser('{name}')) {{
+                database.createUser({{
+                    user: '{name}',
+                    pwd: '{secret}',
+                    roles: [],
+                }});
+            }}
+            database.updateUser('{name}', {{
+                pwd: '{password}',
+                roles: [
+                    {{db: 'local', role: 'read'}},
+                    {{db: '{name}', role: 'readWrite'}},
+                ],
+            }});
+        """),
+        'undo': cleandoc("""
+            db.getSiblingDB('{name}').updateUser('{name}', {{
+                pwd: '{secret}',
+            }});
+        """),
+        'purge': cleandoc("""
+            database = db.getSiblingDB('{name}');
+            database.dropAllUsers();
+            database.dropDatabase();
+        """),
+    }
+
+    def session(self, engine, statements):
+        tag = '_' + self.token(20, *statements)
+        body = '\n'.join(statements)
+
+        if self.SECRET not in body:
+            return f"{self.CLIENTS[engine]} << '{tag}'\n{body}\n{tag}"
+
+        # secrets are made up on the host, so the package itself stays free of them
+        return (
+            'secret=$(tr -dc A-Za-z0-9 < /dev/urandom | head -c 32)\n'
+            f'sed "s/{self.SECRET}/$secret/g" << \'{tag}\' | {self.CLIENTS[engine]}\n{body}\n{tag}'
+        )
+
     def _parse_debian_yml_1(self, _, databases):
+        templates = {'mysql': self.MYSQL, 'psql': self.PSQL, 'mongosh': self.MONGOSH}
+        sessions = {engine: {'install': [], 'undo': [], 'purge': []} for engine in templates}
+
+        for database in databases:
+            database['secret'] = self.SECRET
+
+            for phase, statements in sessions[database['type']].items():
+                statements.append(templates[database['type']][phase].format(**database))
+
+        # extensions need a connection to their database, so they go last in the same session
         for database in databases:
-            database['secret'] = self.token(32)
-
-            if database['type'] == 'mysql':
-                self.scripts.install(cleandoc("""
-                    mysql << EOF
-                        CREATE DATABASE IF NOT EXISTS {name};
-                        CREATE USER IF NOT EXISTS {name} IDENTIFIED BY '{secret}';
-                        GRANT ALL PRIVILEGES ON {name}.* TO {name};
-                        ALTER USER {name} IDENTIFIED BY '{password}';
-                    EOF
-                """.format(**database)), cleandoc("""
-                    mysql << EOF
-                        ALTER USER {name} IDENTIFIED BY '{secret}';
-                    EOF
-                """.format(**database)))
-                self.scripts.purge(cleandoc("""
-                    mysql << EOF
-                        DROP DATABASE {name};
-                        DROP USER {name};
-                    EOF
-                """.format(**database)))
-
-            if database['type'] == 'psql':
-                self.scripts.install(cleandoc("""
-                    sudo -u postgres psql << EOF
-                        CREATE DATABASE {name};
-                        CREATE USER {name} WITH PASSWORD '{secret}';
-                        ALTER DATABASE {name} OWNER TO {name};
-                        ALTER USER {name} WITH PASSWORD '{password}';
-                    EOF
-                """.format(**database)), cleandoc("""
-                    sudo -u postgres psql << EOF
-                        ALTER USER {name} WITH PASSWORD '{secret}';
-                    EOF
-                """.format(**database)))
-                self.scripts.purge(cleandoc("""
-                    sudo -u postgres psql << EOF
-                        DROP DATABASE {name} WITH (FORCE);
-                        DROP USER {name};
-                    EOF
-                """.format(**database)))
-                if 'extensions' in database:
-                    install = ['sudo -u postgres psql ' + database['name'] + ' << EOF', 'EOF']
-                    for extension in database['extensions']:
-                        install.insert(-1, f'    CREATE EXTENSION IF NOT EXISTS {extension};')
-                    self.scripts.install('\n'.join(install), False)
-
-            if database['type'] == 'mongosh':
-                self.scripts.install(cleandoc("""
-                    mongosh << EOF
-                        use {name};
-                        if (!db.getUser('{name}')) {{
-                            db.createUser({{
-                                user: '{name}',
-                                pwd: '{secret}',
-                                roles: [],
-                            }});
-                        }}
-                        db.updateUser('{name}', {{
-                            pwd: '{password}',
-                            roles: [
-                                {{db: 'local', role: 'read'}},
-                                {{db: '{name}', role: 'readWrite'}},
-                            ],
-                        }});
-                    EOF
-                """.format(**database)), cleandoc("""
-                    mongosh << EOF
-                        use {name};
-                        db.updateUser('{name}', {{
-                            pwd: '{secret}',
-                        }});
-                    EOF
-                """.format(**database)))
-                self.scripts.purge(cleandoc("""
-                    mongosh << EOF
-                        use {name};
-                        db.dropAllUsers();
-                        db.dropDatabase();
-                    EOF
-                """.format(**database)))
+            if database['type'] == 'psql' and 'extensions' in database:
+                sessions['psql']['install'].append(f'\\connect {database["name"]}')
+                for extension in database['extensions']:
+                    sessions['psql']['install'].append(f'CREATE EXTENSION IF NOT EXISTS {extension};')
+
+        for engine, phases in sessions.items():
+            if phases['install']:
+                self.scripts.install(self.session(engine, phases['install']), self.session(engine, phases['undo']))
+                self.scripts.purge(self.session(engine, phases['purge']))
 
 
 class CompressGzip(BaseModule):
@@ -695,11 +1063,14 @@ class CompressGzip(BaseModule):
     def process_file(self, path, fp):
         if str(path) in self.compress:
             with self.prepare(path.parent / (path.name + '.gz'), 0o644, path) as output:
+                import gzip
                 with gzip.open(output, 'wb') as gz:
                     copyfileobj(fp, gz)
 
 
 class SystemUsers(BaseModule):
+    STATELESS = True
+
     def _parse_debian_yml_1(self, _, users):
         for user in users:
             user.setdefault('home', '/dev/null')
@@ -715,17 +1086,27 @@ class SystemUsers(BaseModule):
 
 
 class AutoDiversions(BaseModule):
+    STATELESS = True
+
+    def __init__(self, source, target):
+        super().__init__(source, target)
+        self.paths = []
+
     def on_file_write(self, remote, local):
-        self.scripts.install(cleandoc(f"""
-            if [[ -f "{remote}" ]] || [[ -f "{remote}.dpkg-new" ]] || [[ -f "{remote}.ucf-dist" ]]; then
-                dpkg-divert --rename --divert "{remote}.ucf-dist" --add "{remote}"
-            fi
-        """), cleandoc(f"""
-            dpkg-divert --quiet --rename --divert "{remote}.ucf-dist" --remove "{remote}"
-        """), when='before')
+        self.paths.append(str(remote))
+
+    def finalize(self):
+        if self.paths:
+            self.scripts.install(
+                self.snippet_inline('divert-files.py', 'add', stdin='\n'.join(self.paths)),
+                self.snippet_inline('divert-files.py', 'remove', stdin='\n'.join(self.paths)),
+                when='before',
+            )
 
 
 class ApplyPatches(BaseModule):
+    STATELESS = True
+
     def on_file_write(self, remote, local):
         if remote.suffix == '.patch':
             original = remote.parent / remote.stem
@@ -747,21 +1128,30 @@ class ApplyPatches(BaseModule):
 
 
 class DockerContainers(BaseModule):
-    def _parse_debian_yml_1(self, _, docker):
-        for container in docker:
-            setup = 'docker run --restart unless-stopped --add-host host.docker.internal:host-gateway'
-            purge = 'docker volume rm'
+    def __init__(self, source, target):
+        super().__init__(source, target)
+        self.parallelism = 4
+
+    def _parse_debian_yml_1(self, _, parallelism):
+        self.parallelism = parallelism
+
+    def _parse_debian_yml_2(self, _, maintenance):
+        self.overrides = maintenance
 
+    def _parse_debian_yml_3(self, _, docker):
+        spec = PurePath('/etc/docker/reversible/') / (self.source.name + '.json')
+        images = self.snippet_file('docker-images.py', spec)
+        self.scripts.install(images, False, when='after')
+
+        for container in docker:
             if 'build' in container:
-                dockerfile = PurePath(container['build'])
-                image = container['image'] = slugify(str(dockerfile))
-                build = f'docker build --tag "{image}" --file "{dockerfile}" "{dockerfile.parent}"'
+                container['image'] = slugify(str(PurePath(container['build'])))
 
-                if 'arguments' in container:
-                    for key, value in container['arguments'].items():
-                        build += f' --build-arg "{key}={value}"'
+        containers = {}
 
-                setup = build + '\n' + setup
+        for container in docker:
+            setup = 'docker run --restart unless-stopped --add-host host.docker.internal:host-gateway'
+            purge = 'docker volume rm'
 
             if 'mounts' in container:
                 for definition in container['mounts']:
@@ -807,36 +1197,58 @@ class DockerContainers(BaseModule):
                 self.scripts.purge(purge)
             self.scripts.install(setup, remove, when='after')
 
+            containers[container['name']] = {
+                'image': container['image'],
+                'remove': remove.split('\n'),
+                'setup': setup.split('\n'),
+            }
+
             if 'rebuild' in container and not container['rebuild']:
                 continue
 
-            with self.write('/lib/systemd/system/docker-' + container['name'] + '-rebuild.timer', False) as fp:
-                fp.write(cleandoc("""
-                    [Unit]
-                    Description=rebuild of "{name}" Docker container
-                    [Timer]
-                    OnCalendar=*-*-* 06:00:00
-                    Persistent=true
-                    RandomizedDelaySec=1h
-                    [Install]
-                    WantedBy=timers.target
-                """.format(**container)))
-
-            with self.write('/lib/systemd/system/docker-' + container['name'] + '-rebuild.service', False) as fp:
-                fp.write(cleandoc("""
-                    [Unit]
-                    Description=rebuild of "{name}" Docker container
-                    [Service]
-                    Type=oneshot
-                """.format(**container)) + '\n')
-                for command in remove.split('\n'):
-                    fp.write("ExecStartPre=/bin/bash -c '" + command + "'\n")
-                for command in setup.split('\n'):
-                    fp.write("ExecStart=/bin/bash -c '" + command + "'\n")
+            self.timer(
+                'docker-' + container['name'] + '-rebuild', 'rebuild of "{name}" Docker container'.format(**container),
+                '*-*-* 06:00:00', [images + ' --rebuild "' + container['name'] + '"'],
+            )
+
+        with self.write(spec, False) as fp:
+            json.dump({
+                'jobs': self.parallelism,
+                'images': [{
+                    'image': container['image'],
+                    'dockerfile': container.get('build'),
+                    'arguments': container.get('arguments', {}),
+                } for container in docker],
+                'containers': containers,
+            }, fp, indent=2)
 
 
 class GitRepo(BaseModule):
-    def _parse_git_yml_1(self, path, url, branch, user, pre, post):
+    STATELESS = True
+
+    def __init__(self, source, target):
+        super().__init__(source, target)
+        self.parallelism = 4
+        self.repos = []
+
+    def _parse_debian_yml_1(self, _, parallelism):
+        self.parallelism = parallelism
+
+    def _parse_debian_yml_2(self, _, maintenance):
+        self.overrides = maintenance
+
+    def finalize(self):
+        if not self.repos:
+            return
+
+        self.scripts.install(self.snippet_inline('clone-managed-repos.py', stdin=json.dumps({
+            'jobs': self.parallelism,
+            'repos': self.repos,
+        }, indent=2)), self.snippet_inline(
+            'remove-managed-repo.py', *[repo['path'] for repo in self.repos]
+        ), when='before')
+
+    def _parse_git_yml_1(self, path, url, branch, user, pre, post, depth, filter, cache):
         self.control['pre-depends'] = ['git']
 
         if user is None:
@@ -850,48 +1262,48 @@ class GitRepo(BaseModule):
             with self.write(path.parent / '.git' / 'hooks' / 'post-pull', True) as fp:
                 fp.write(post)
 
-        self.scripts.install(cleandoc(f"""
-            mkdir -p "{path.parent}"
-            chown {user}:{user} "{path.parent}"
-            cd "{path.parent}"
-            sudo -u {user} git init
-            sudo -u {user} git remote add origin "{url}"
-            sudo -u {user} git fetch
-            sudo -u {user} git checkout "{branch}"
-            sudo -u {user} git submodule update --init --recursive
-        """), self.snippet_inline('remove-managed-repo.py', path.parent), when='before')
+        self.repos.append({
+            'path': str(path.parent),
+            'url': url,
+            'branch': branch,
+            'user': user,
+            'depth': depth,
+            'filter': filter,
+            'cache': bool(cache),
+        })
         self.scripts.purge(f'rm -r "{path.parent}"')
 
-        with self.write(f'/lib/systemd/system/{slug}.timer', False) as fp:
-            fp.write(cleandoc(f"""
-                [Unit]
-                Description=pulling and processing git repo at "{path.parent}"
-                [Timer]
-                OnCalendar=daily
-                Persistent=true
-                RandomizedDelaySec=1h
-                [Install]
-                WantedBy=timers.target
-            """))
-
-        with self.write(f'/lib/systemd/system/{slug}.service', False) as fp:
-            fp.write(cleandoc(f"""
-                [Unit]
-                Description=pulling and processing git repo at "{path.parent}"
-                [Service]
-                Type=oneshot
-                User={user}
-                WorkingDirectory={path.parent}
-            """))
-            fp.write('\n' + 'ExecStart=' + self.snippet_file('update-managed-repo.py'))
+        self.timer(
+            slug, f'pulling and processing git repo at "{path.parent}"',
+            'daily', [self.snippet_file('update-managed-repo.py')],
+            User=user, WorkingDirectory=path.parent,
+        )
 
-        self.scripts.install(f'systemctl start {slug}.service', False, when='after')
+        self.scripts.install(f'systemctl start --no-block {slug}.service', False, when='after')
 
 
 class MuninPlugins(BaseModule):
+    STATELESS = True
+
     def on_file_write(self, remote, local):
         if remote.parent == PurePath('/usr/share/munin/plugins/'):
-            self.scripts.trigger('systemctl try-restart munin-node')
+            self.debounce('try-restart', 'munin-node')
+
+    def _parse_debian_yml_1(self, _, metrics):
+        if not metrics:
+            return
+        self.control['depends'] = ['munin-node', 'python3']
+
+        # the journal holds the metric lines of every package, reading it needs the journal group
+        with self.write('/etc/munin/plugin-conf.d/reversible', False) as fp:
+            fp.write('[reversible]\ngroup systemd-journal\n')
+
+        with self.prepare('/etc/munin/plugins/reversible') as enabled:
+            enabled.symlink_to('/usr/share/munin/plugins/reversible')
+
+        with open(Path(__file__).parent / 'scripts' / 'munin-reversible.py', 'r') as fp1:
+            with self.write('/usr/share/munin/plugins/reversible', True) as fp2:
+                copyfileobj(fp1, fp2)
 
 
 class BorgCacheDir(BaseModule):
@@ -931,6 +1343,8 @@ class UserScripts(BaseModule):
 
 
 class ClaimFiles(BaseModule):
+    STATELESS = True
+
     def _parse_debian_yml_1(self, _, claims):
         for claim in claims:
             self.scripts.install(
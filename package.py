@@ -1,9 +1,21 @@
-from modules import *
+from archive import build_deb, collect, final_mode, normalise
+from modules import (
+    BaseModule, ModuleScripts,
+    ControlFile, CopyFiles, SecureFiles, Triggers, CompressGzip, AutoDiversions, SystemUsers,
+    PackageManagers, OpenPorts, DNS, ReverseProxy, SharedFolders, AptSources, ManageDBs,
+    WebSites, ApplyPatches, MuninPlugins, BorgCacheDir, UserScripts, GitRepo,
+    SystemdUnits1, SystemdUnits2, DockerContainers, ClaimFiles,
+)
 from pathlib import Path, PurePath
 from tempfile import TemporaryDirectory
-from os import readlink, remove
-from subprocess import run
-from ruamel.yaml import YAML
+from os import environ, lstat, readlink, remove, utime
+from stat import S_ISDIR, S_ISLNK
+from shutil import copyfile, which
+from subprocess import run, PIPE, DEVNULL
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from importlib import import_module
+from importlib.metadata import entry_points
 from inspect import cleandoc
 
 
@@ -33,10 +45,28 @@ class Package:
         DockerContainers,
         ClaimFiles,
     ]
-    LOADER = YAML(typ='unsafe').load
+    PLUGINS = 'reversible.modules'
+    APT = 'sudo DEBIAN_FRONTEND=noninteractive apt-get -yq -o DPkg::Lock::Timeout=600'
+    STORE = Path.home() / '.cache' / 'reversible' / 'debs'
+    REMOTE = PurePath('/var/cache/reversible/debs')
+    KEEP = 3
 
     def __init__(self, name):
         self.package = Path(name).resolve()
+        self.control = {}
+        self.version = None
+        self.digest = None
+        self.profile = False
+        self.native = False
+        self.timings = {}
+
+    def dependencies(self):
+        names = set()
+        for key in ('depends', 'pre-depends'):
+            for item in self.control.get(key, ()):
+                for alternative in item.split('|'):
+                    names.add(alternative.split('(')[0].split(':')[0].strip())
+        return names
 
     def deploy(self):
         targets = []
@@ -46,26 +76,202 @@ class Package:
                 if line:
                     targets.append(line)
 
-        for target in targets:
-            run(('scp', f'/tmp/{self.package.name}.deb', f'{target}:/tmp/{self.package.name}.deb'))
+        # ask all hosts what they run, and leave those with the same contents alone
+        with ThreadPoolExecutor(len(targets) or 1) as pool:
+            states = dict(zip(targets, pool.map(self.preflight, targets)))
+
+        outdated = []
+        for target, (installed, digest, capable) in states.items():
+            if digest == self.digest:
+                print(f'{self.package.name} -> {target}: version {installed} has the same contents, skipping')
+            else:
+                outdated.append(target)
+
+        # keep the deployed archive around as a base for later deltas
+        store = self.STORE / self.package.name
+        store.mkdir(parents=True, exist_ok=True)
+        copyfile(f'/tmp/{self.package.name}.deb', store / f'{self.version}.deb')
+
+        for target in outdated:
+            self.upload(target, store, *states[target])
             run(args=('ssh', target, 'bash -'), input=cleandoc(f"""
-                sudo DEBIAN_FRONTEND=noninteractive apt-get -yq update
-                sudo DEBIAN_FRONTEND=noninteractive apt-get -yq remove {self.package.name}
-                sudo DEBIAN_FRONTEND=noninteractive apt-get -yq install /tmp/{self.package.name}.deb
-                rm /tmp/{self.package.name}.deb
+                {self.APT} update
+                {self.APT} remove {self.package.name}
+                start=$(date +%s%N)
+                {self.APT} install /tmp/{self.package.name}.deb && result=success || result=failed
+                took=$(( $(date +%s%N) - start ))
+                logger -t reversible "metric=package-install package={self.package.name} version={self.version} result=$result duration=$(( took / 1000000000 )).$(printf %03d $(( took / 1000000 % 1000 )))"
+                [ $result = failed ] || {{ \\
+                    sudo mkdir -p "{self.REMOTE}" && \\
+                    sudo mv /tmp/{self.package.name}.deb "{self.REMOTE / self.package.name}.deb"; }}
+                rm -f /tmp/{self.package.name}.deb
             """).encode('UTF8'))
 
+        if self.profile:
+            with ThreadPoolExecutor(len(outdated) or 1) as pool:
+                self.timings = dict(zip(outdated, pool.map(self.collect, outdated)))
+
+        for old in sorted(store.glob('*.deb'), key=lambda path: path.stat().st_mtime)[:-self.KEEP]:
+            old.unlink()
+        for old in store.glob('*.debdelta'):
+            old.unlink()
+
         remove(f'/tmp/{self.package.name}.deb')
 
+    def collect(self, target):
+        pattern = f'metric=maintainer-snippet package={self.package.name} version={self.version} '
+        result = run((
+            'ssh', target, f'sudo journalctl --quiet --no-pager --output=cat --identifier=reversible --since=-6h --grep="{pattern}"'
+        ), stdout=PIPE, text=True)
+
+        timings = []
+        for line in result.stdout.splitlines():
+            fields = dict(field.split('=', 1) for field in line.split() if '=' in field)
+            timings.append({
+                'phase': fields.get('phase'),
+                'module': fields.get('module'),
+                'status': int(fields.get('status', 0)),
+                'duration': float(fields.get('duration', 0)),
+            })
+
+        if not timings:
+            print(f'{self.package.name} -> {target}: no maintainer script timings found in the journal')
+
+        return timings
+
+    def preflight(self, target):
+        cached = self.REMOTE / f'{self.package.name}.deb'
+
+        # ask which version the host has, and whether it can apply a delta to it
+        result = run(('ssh', target, (
+            f"dpkg-query -W -f='${{db:Status-Abbrev}}\\n${{Version}}\\n${{Content-Hash}}\\n' {self.package.name} 2> /dev/null "
+            f"|| printf '\\n\\n\\n'; "
+            f'test -f "{cached}" && command -v debpatch > /dev/null && echo delta'
+        )), stdout=PIPE, text=True)
+        status, version, digest, capable, *_ = [line.strip() for line in result.stdout.split('\n')] + ['', '', '', '']
+
+        # packages that were removed but not purged still report their old fields
+        if status != 'ii':
+            return '', '', capable == 'delta'
+        return version, digest, capable == 'delta'
+
+    def upload(self, target, store, installed, _, capable):
+        new = f'/tmp/{self.package.name}.deb'
+        cached = self.REMOTE / f'{self.package.name}.deb'
+        base = store / f'{installed}.deb'
+
+        if capable and installed and base.exists() and which('debdelta'):
+            delta = store / f'{installed}-{self.version}.debdelta'
+            if not delta.exists():
+                run(('debdelta', base, new, delta), stdout=DEVNULL)
+
+            if delta.exists():
+                run(('scp', '-q', delta, f'{target}:/tmp/{self.package.name}.debdelta'))
+                patched = run(('ssh', target, (
+                    f'debpatch /tmp/{self.package.name}.debdelta "{cached}" {new} > /dev/null; '
+                    f'status=$?; rm -f /tmp/{self.package.name}.debdelta; exit $status'
+                )))
+                if patched.returncode == 0:
+                    print(f'{self.package.name} -> {target}: delta of {delta.stat().st_size} bytes')
+                    return
+
+        run(('scp', '-q', new, f'{target}:{new}'))
+        print(f'{self.package.name} -> {target}: full archive of {Path(new).stat().st_size} bytes')
+
+    @staticmethod
+    def content_hash(root, control, streams):
+        digest = sha256()
+
+        for key, values in sorted(control.items()):
+            if key != 'version':
+                digest.update(f'{key}: {", ".join(sorted(values))}'.encode() + b'\0')
+
+        for path in sorted((root / 'DEBIAN').iterdir()):
+            if path.name != 'control':
+                digest.update(f'DEBIAN/{path.name}'.encode() + b'\0' + path.read_bytes() + b'\0')
+
+        # hash what ends up in the archive, so both writers agree on the same contents
+        entries = collect(root, streams)
+        folders = {parent for relative in entries for parent in relative.parents[:-1]}
+
+        for relative in sorted(entries.keys() | folders, key=lambda path: path.parts):
+            info = lstat(entries[relative][1]) if relative in entries else None
+            if info is None or S_ISDIR(info.st_mode):
+                digest.update(f'dir {relative}'.encode() + b'\0')
+                continue
+
+            _, source, mode, text = entries[relative]
+            if S_ISLNK(info.st_mode):
+                digest.update(f'link {relative} {readlink(source)}'.encode() + b'\0')
+                continue
+
+            digest.update(f'file {relative} {oct(final_mode(info, mode))}'.encode() + b'\0')
+            with open(source, 'rb') as fp:
+                if text:
+                    digest.update(normalise(fp.read()))
+                else:
+                    for chunk in iter(lambda: fp.read(1048576), b''):
+                        digest.update(chunk)
+            digest.update(b'\0')
+
+        return digest.hexdigest()
+
+    def epoch(self):
+        if 'SOURCE_DATE_EPOCH' in environ:
+            return int(environ['SOURCE_DATE_EPOCH'])
+
+        # default to the last commit touching the package
+        result = run(('git', 'log', '-1', '--format=%ct', '--', '.'), cwd=self.package, stdout=PIPE, stderr=DEVNULL, text=True)
+        return int(result.stdout.strip() or 0)
+
+    def maintenance(self, loader):
+        settings = {}
+
+        # repository wide settings first, then those of the category
+        for path in (self.package.parent.parent / 'maintenance.yml', self.package.parent / 'maintenance.yml'):
+            if path.exists():
+                settings.update(loader.load(path) or {})
+
+        return settings
+
+    def plugins(self, loader):
+        classes = list(self.MODULES)
+        names = []
+
+        if (self.package / 'DEBIAN.YML').exists():
+            names = (loader.load(self.package / 'DEBIAN.YML') or {}).get('modules') or []
+
+        # only look up and import the extra modules a package asks for
+        available = {entry.name: entry for entry in entry_points(group=self.PLUGINS)} if names else {}
+        for name in names:
+            if name in available:
+                module = available[name].load()
+            elif ':' in name:
+                path, attribute = name.split(':', 1)
+                module = getattr(import_module(path), attribute)
+            else:
+                raise ValueError(f'Unknown module "{name}" requested by package "{self.package.name}"!')
+
+            # extra modules run after the built-in ones, but ClaimFiles stays last
+            classes.insert(-1, module)
+
+        return classes
+
     def build(self):
+        from ruamel.yaml import YAML
+
         with TemporaryDirectory() as temp:
             temp = Path(temp)
 
             # prepare build folder
             (temp / 'DEBIAN').mkdir()
+            if self.native:
+                BaseModule.STREAMS[temp] = {}
 
             # construct modules in order
-            modules = [M(self.package, temp) for M in self.MODULES]
+            loader = YAML(typ='unsafe')
+            BaseModule.DEFAULTS[temp] = self.maintenance(loader)
+            modules = [M(self.package, temp) for M in self.plugins(loader)]
 
             # build cache of special files
             patterns = {'purge.sh', 'preinst.sh', 'postinst.sh', 'prerm.sh', 'postrm.sh', 'version'}
@@ -80,8 +286,8 @@ class Package:
                 for match in self.package.glob(pattern):
                     yaml.add(match)
 
-            # process all source files
-            for path in self.package.glob('**/*'):
+            # process all source files, package wide settings first
+            for path in sorted(self.package.glob('**/*'), key=lambda path: (path != self.package / 'DEBIAN.YML', path)):
                 absolute = PurePath('/') / path.relative_to(self.package)
 
                 # skip special files
@@ -90,7 +296,7 @@ class Package:
 
                 # manage YAML files
                 if path in yaml:
-                    content = self.LOADER(path)
+                    content = loader.load(path)
                     for module in modules:
                         module.process_yaml(absolute, content)
                     continue
@@ -110,6 +316,11 @@ class Package:
                             fp.seek(0)
                     continue
 
+            # let modules emit their collected scripts
+            for module in modules:
+                module.finalize()
+            BaseModule.DEFAULTS.pop(temp)
+
             # load and increment package version
             if (self.package / 'version').exists():
                 with open(self.package / 'version', 'r') as fp:
@@ -128,47 +339,48 @@ class Package:
                         combined[key] = set()
                     combined[key].update(values)
 
-            with open(temp / 'DEBIAN' / 'control', 'w') as fp:
-                for key, values in combined.items():
-                    fp.write(key.title() + ': ' + ', '.join(values) + '\n')
-
             # combine module script trackers
             scripts = ModuleScripts()
             for module in modules:
                 scripts += module.scripts
 
             # write actual package scripts
-            for phase in ('preinst', 'postinst', 'prerm', 'postrm'):
-                content = []
-
-                if phase in {'postinst', 'postrm'}:
-                    content += scripts.prepares
+            for phase in ModuleScripts.PHASES:
+                tag = f'package={self.package.name} version={version}' if self.profile else None
+                text, snippets, subshells = scripts.assemble(phase, tag)
+                if text is not None:
+                    with open(temp / 'DEBIAN' / phase, 'w') as fp:
+                        fp.write(text)
+                    (temp / 'DEBIAN' / phase).chmod(0o755)
+                    print(f'{self.package.name} {phase}: {snippets} snippets in {subshells} subshells, {len(text)} bytes')
 
-                content += scripts.stages[phase]
+            # identify the contents independently of the version
+            combined['content-hash'] = {self.content_hash(temp, combined, BaseModule.STREAMS.get(temp, {}))}
 
-                if phase in {'postinst', 'postrm'}:
-                    content += scripts.triggers
+            with open(temp / 'DEBIAN' / 'control', 'w') as fp:
+                for key, values in combined.items():
+                    fp.write(key.title() + ': ' + ', '.join(sorted(values)) + '\n')
 
-                if content or (phase == 'postrm' and scripts.purges):
-                    with open(temp / 'DEBIAN' / phase, 'w') as fp:
-                        fp.write('#!/bin/bash')
-                        if phase in {'preinst', 'prerm'}:
-                            fp.write('\nset -e')
-                        if phase == 'postrm':
-                            fp.write('\n\nif [[ "$1" == "purge" ]]; then')
-                            fp.writelines((
-                                '\n\n(\n' + item + '\n)' for item in scripts.purges
-                            ))
-                            fp.write('\n\nexit 0; fi')
-                        fp.writelines((
-                            '\n\n(\n' + item + '\n)' for item in content
-                        ))
-                        fp.write('\n\nexit 0\n')
-                    (temp / 'DEBIAN' / phase).chmod(0o755)
+            # pin all timestamps, so equal inputs give equal archives
+            epoch = self.epoch()
+            temp.chmod(0o755)
+            for path in [temp, *temp.glob('**/*')]:
+                utime(path, (epoch, epoch), follow_symlinks=False)
 
-            # use dpkg to build .deb archive
-            run(('dpkg-deb', '--root-owner-group', '-Zxz', '--build', temp, '/tmp/' + self.package.name + '.deb'))
+            # build .deb archive, streaming sources directly when native
+            if self.native:
+                build_deb(temp, BaseModule.STREAMS.pop(temp), '/tmp/' + self.package.name + '.deb', epoch)
+            else:
+                run(
+                    ('dpkg-deb', '--root-owner-group', '-Zxz', '--build', temp, '/tmp/' + self.package.name + '.deb'),
+                    env={**environ, 'SOURCE_DATE_EPOCH': str(epoch)},
+                )
 
             # save new version after successful build
             with open(self.package / 'version', 'w') as fp:
                 fp.write(str(version))
+
+            self.control = combined
+            self.version = version
+            self.digest = next(iter(combined['content-hash']))
+            BaseModule.LISTENERS.pop(temp)
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+from sys import stdin
+from os import chmod, chown, makedirs, stat
+from stat import S_IMODE
+from pwd import getpwnam
+from grp import getgrnam
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def lookup(user):
+    return getpwnam(user).pw_uid, getgrnam(user).gr_gid
+
+
+def apply(kind, user, path):
+    uid, gid = lookup(user)
+    changed = False
+
+    if kind == 'folder':
+        makedirs(path, exist_ok=True)
+
+    info = stat(path)
+    mode = S_IMODE(info.st_mode)
+
+    if kind == 'secure' and mode & 0o077:
+        chmod(path, mode & ~0o077)
+        changed = True
+
+    if (info.st_uid, info.st_gid) != (uid, gid):
+        chown(path, uid, gid)
+        changed = True
+
+    return changed
+
+
+if __name__ == '__main__':
+    total, changed, failed = 0, 0, 0
+
+    for line in stdin:
+        if not line.strip():
+            continue
+        kind, user, path = line.rstrip('\n').split(' ', 2)
+        total += 1
+
+        try:
+            changed += apply(kind, user, path)
+        except (OSError, KeyError) as e:
+            print(f'Failed to apply permissions to "{path}": {e}')
+            failed += 1
+
+    print(f'Checked {total} paths, {changed} changed, {failed} failed.')
+    if failed:
+        exit(1)
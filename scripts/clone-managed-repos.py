@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+from sys import stdin
+from json import load
+from hashlib import sha1
+from os import chown, geteuid, makedirs
+from os.path import isdir, join
+from pwd import getpwnam, getpwuid
+from subprocess import run, CalledProcessError, DEVNULL, PIPE
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+from threading import Lock
+from time import monotonic
+
+CACHE = '/var/lib/reversible/git-objects'
+LOCKS = defaultdict(Lock)
+
+
+def git(user, path, *args, check=True):
+    command = ('git', *args)
+    if user != getpwuid(geteuid()).pw_name:
+        command = ('sudo', '-u', user) + command
+    return run(command, cwd=path, check=check, stdout=DEVNULL, stderr=None if check else PIPE).returncode
+
+
+def fill_cache(cache, url):
+    # one shared object store, with the refs of every remote in their own namespace
+    with LOCKS[cache]:
+        if not isdir(cache):
+            run(('git', 'init', '--quiet', '--bare', cache), check=True)
+
+        # repos borrow objects from here through alternates, so nothing may ever be pruned
+        for key, value in (('gc.auto', '0'), ('gc.pruneExpire', 'never')):
+            run(('git', '--git-dir', cache, 'config', key, value), check=True)
+
+    namespace = 'refs/remotes/' + sha1(url.encode()).hexdigest()
+    with LOCKS[url]:
+        run(('git', '--git-dir', cache, 'fetch', '--quiet', '--no-tags', url, f'+refs/heads/*:{namespace}/*'), check=True)
+
+
+def clone(repo, cache, jobs):
+    path, user = repo['path'], repo['user']
+    start = monotonic()
+
+    makedirs(path, exist_ok=True)
+    info = getpwnam(user)
+    chown(path, info.pw_uid, info.pw_gid)
+
+    git(user, path, 'init', '--quiet')
+    if git(user, path, 'remote', 'get-url', 'origin', check=False):
+        git(user, path, 'remote', 'add', 'origin', repo['url'])
+
+    # the cache is filled as root, remotes only the repo user can reach are fetched without it
+    if repo['cache']:
+        try:
+            fill_cache(cache, repo['url'])
+            with open(join(path, '.git', 'objects', 'info', 'alternates'), 'w') as fp:
+                fp.write(join(cache, 'objects') + '\n')
+        except CalledProcessError:
+            print(f'Filling the object cache from "{repo["url"]}" failed, fetching "{path}" without it.')
+
+    fetch = ['fetch', '--quiet', 'origin']
+    if repo['depth']:
+        fetch.append(f'--depth={repo["depth"]}')
+    if repo['filter']:
+        fetch.append(f'--filter={repo["filter"]}')
+
+    git(user, path, *fetch)
+    git(user, path, 'checkout', '--quiet', repo['branch'])
+    git(user, path, 'submodule', 'update', '--quiet', '--init', '--recursive', f'--jobs={jobs}')
+
+    return path, monotonic() - start
+
+
+if __name__ == '__main__':
+    spec = load(stdin)
+
+    with ThreadPoolExecutor(spec['jobs']) as pool:
+        futures = [pool.submit(clone, repo, spec.get('cache', CACHE), spec['jobs']) for repo in spec['repos']]
+
+    failed = 0
+    for future in futures:
+        try:
+            path, duration = future.result()
+            print(f'Cloned "{path}" in {duration:.1f} seconds.')
+        except Exception as e:
+            print(f'Failed to clone repository: {e}')
+            failed += 1
+
+    if failed:
+        exit(1)
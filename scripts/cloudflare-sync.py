@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser
+from json import dump, dumps, load, loads
+from glob import glob
+from os import makedirs
+from os.path import exists, join
+from time import monotonic, sleep
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError, URLError
+from syslog import openlog, syslog
+
+FIELDS = ('type', 'name', 'content', 'ttl', 'proxied')
+TRACE = {
+    'A': 'https://1.1.1.1/cdn-cgi/trace',
+    'AAAA': 'https://[2606:4700:4700::1111]/cdn-cgi/trace',
+}
+
+
+class Client:
+    def __init__(self, api, token, rate, retries):
+        self.api = api.rstrip('/')
+        self.token = token
+        self.interval = 1 / rate
+        self.retries = retries
+        self.last = 0
+        self.requests = 0
+
+    def call(self, method, path, body=None):
+        for attempt in range(self.retries + 1):
+            # space out requests to stay below the rate limit
+            wait = self.last + self.interval - monotonic()
+            if wait > 0:
+                sleep(wait)
+            self.last = monotonic()
+            self.requests += 1
+
+            request = Request(self.api + path, method=method, headers={
+                'Authorization': f'Bearer {self.token}',
+                'Content-Type': 'application/json',
+            }, data=None if body is None else dumps(body).encode('UTF8'))
+
+            try:
+                with urlopen(request, timeout=30) as response:
+                    return loads(response.read())['result']
+            except HTTPError as e:
+                if (e.code != 429 and e.code < 500) or attempt == self.retries:
+                    raise
+                delay = float(e.headers.get('Retry-After') or 2 ** attempt)
+            except URLError:
+                if attempt == self.retries:
+                    raise
+                delay = 2 ** attempt
+
+            sleep(delay)
+
+    def records(self, zone):
+        records = []
+
+        for page in range(1, 1000):
+            result = self.call('GET', f'/zones/{zone}/dns_records?per_page=1000&page={page}')
+            records += result
+            if len(result) < 1000:
+                break
+
+        return records
+
+    def batch(self, zone, deletes, patches, posts):
+        return self.call('POST', f'/zones/{zone}/dns_records/batch', {
+            'deletes': deletes,
+            'patches': patches,
+            'posts': posts,
+        })
+
+
+def key(record):
+    return record['type'] + ' ' + record['name']
+
+
+def detect_address(kind, addresses):
+    for address in addresses:
+        if (':' in address) == (kind == 'AAAA'):
+            return address
+
+    with urlopen(TRACE[kind], timeout=10) as response:
+        for line in response.read().decode('UTF8').splitlines():
+            if line.startswith('ip='):
+                addresses.append(line[3:])
+                return line[3:]
+
+
+def load_records(directory, addresses):
+    records = {}
+
+    for path in sorted(glob(join(directory, '*.json'))):
+        with open(path, 'r') as fp:
+            content = load(fp)
+
+        # accept a list of records or a mapping from record type to records
+        if isinstance(content, dict):
+            content = [
+                item if isinstance(item, dict) else {'type': kind, 'name': item}
+                for kind, items in content.items() for item in items
+            ]
+
+        for item in content:
+            record = {'type': 'A', 'ttl': 1, 'proxied': False}
+            record.update({'name': item} if isinstance(item, str) else item)
+            if 'content' not in record:
+                record['content'] = detect_address(record['type'], addresses)
+            records[key(record)] = {field: record[field] for field in FIELDS}
+
+    return records
+
+
+def find_zone(zones, name):
+    matches = [zone for zone in zones if name == zone or name.endswith('.' + zone)]
+    return zones[max(matches, key=len)] if matches else None
+
+
+def diff(desired, snapshot):
+    deletes, patches, posts = [], [], []
+
+    for name, record in desired.items():
+        if name not in snapshot['records']:
+            posts.append(record)
+        elif any(snapshot['records'][name].get(field) != record[field] for field in FIELDS):
+            patches.append({'id': snapshot['records'][name]['id'], **record})
+
+    for name in snapshot['managed']:
+        if name not in desired and name in snapshot['records']:
+            deletes.append({'id': snapshot['records'][name]['id']})
+
+    return deletes, patches, posts
+
+
+def sync(client, zone, desired, cache, args):
+    path = join(cache, zone + '.json')
+    snapshot = None
+    fresh = False
+
+    if exists(path) and not args.refresh:
+        with open(path, 'r') as fp:
+            snapshot = load(fp)
+
+    while True:
+        if snapshot is None:
+            snapshot = {
+                'records': {key(record): record for record in client.records(zone)},
+                'managed': [],
+            }
+            fresh = True
+
+        deletes, patches, posts = diff(desired, snapshot)
+        if args.dry_run:
+            for operation, items in (('delete', deletes), ('update', patches), ('create', posts)):
+                for item in items:
+                    print(operation, dumps(item))
+            return deletes, patches, posts
+
+        try:
+            for i in range(0, max(len(deletes), len(patches), len(posts)), args.batch):
+                if not (deletes[i:i + args.batch] or patches[i:i + args.batch] or posts[i:i + args.batch]):
+                    continue
+                result = client.batch(zone, deletes[i:i + args.batch], patches[i:i + args.batch], posts[i:i + args.batch])
+
+                # keep the snapshot in step with the remote zone
+                removed = {item['id'] for item in result.get('deletes') or []}
+                snapshot['records'] = {
+                    name: record for name, record in snapshot['records'].items() if record['id'] not in removed
+                }
+                for record in (result.get('patches') or []) + (result.get('posts') or []):
+                    snapshot['records'][key(record)] = record
+        except HTTPError:
+            # the cached snapshot was stale, retry once against the live zone
+            if fresh:
+                raise
+            snapshot = None
+            continue
+
+        break
+
+    snapshot['managed'] = sorted(desired)
+    snapshot['records'] = {
+        name: {field: record[field] for field in FIELDS + ('id',) if field in record}
+        for name, record in snapshot['records'].items()
+    }
+
+    makedirs(cache, exist_ok=True)
+    with open(path, 'w') as fp:
+        dump(snapshot, fp, indent=2)
+
+    return deletes, patches, posts
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Push the differences between local record files and Cloudflare zones.')
+    parser.add_argument('--config', default='/etc/cloudflare/sync.json', help='JSON file with "token" and a "zones" name to ID map')
+    parser.add_argument('--records', default='/etc/cloudflare/records/', help='directory with record files')
+    parser.add_argument('--cache', default='/var/cache/cloudflare/', help='directory for remote zone snapshots')
+    parser.add_argument('--api', default='https://api.cloudflare.com/client/v4', help='base URL of the API')
+    parser.add_argument('--address', action='append', default=[], help='address for records without content')
+    parser.add_argument('--batch', type=int, default=100, help='maximum operations of each kind per request')
+    parser.add_argument('--rate', type=float, default=4, help='maximum requests per second')
+    parser.add_argument('--retries', type=int, default=5, help='retries for rate limited or failed requests')
+    parser.add_argument('--refresh', action='store_true', help='ignore the cached snapshots')
+    parser.add_argument('--dry-run', action='store_true', help='only print the changes')
+    args = parser.parse_args()
+
+    if not exists(args.config):
+        print(f'No configuration at "{args.config}", skipping synchronisation.')
+        exit(0)
+
+    with open(args.config, 'r') as fp:
+        config = load(fp)
+
+    client = Client(args.api, config['token'], args.rate, args.retries)
+    desired = {zone: {} for zone in config['zones'].values()}
+
+    for name, record in load_records(args.records, args.address).items():
+        zone = find_zone(config['zones'], record['name'])
+        if zone is None:
+            print(f'Skipping record "{name}" outside of the configured zones.')
+        else:
+            desired[zone][name] = record
+
+    openlog('reversible')
+    for zone, records in desired.items():
+        start = monotonic()
+        deletes, patches, posts = sync(client, zone, records, args.cache, args)
+
+        message = (
+            f'metric=cloudflare-sync zone={zone} creates={len(posts)} updates={len(patches)} '
+            f'deletes={len(deletes)} requests={client.requests} duration={monotonic() - start:.3f}'
+        )
+        print(message)
+        if not args.dry_run:
+            syslog(message)
+        client.requests = 0
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+from sys import argv, stdin
+from os import environ, fsync, rename, replace
+from os.path import exists, isfile, lexists
+from shutil import copyfile
+
+DIVERSIONS = '/var/lib/dpkg/diversions'
+
+
+def read_diversions():
+    diversions = {}
+
+    if exists(DIVERSIONS):
+        with open(DIVERSIONS, 'r') as fp:
+            lines = fp.read().splitlines()
+        for i in range(0, len(lines) - 2, 3):
+            diversions[lines[i]] = (lines[i + 1], lines[i + 2])
+
+    return diversions
+
+
+def write_diversions(diversions):
+    with open(DIVERSIONS + '-new', 'w') as fp:
+        for path, (divert, package) in diversions.items():
+            fp.write(f'{path}\n{divert}\n{package}\n')
+        fp.flush()
+        fsync(fp.fileno())
+
+    if exists(DIVERSIONS):
+        copyfile(DIVERSIONS, DIVERSIONS + '-old')
+    replace(DIVERSIONS + '-new', DIVERSIONS)
+
+
+def add(diversions, package, paths):
+    renames = []
+
+    for path in paths:
+        divert = path + '.ucf-dist'
+
+        if not (isfile(path) or isfile(path + '.dpkg-new') or isfile(divert)):
+            continue
+        if path in diversions:
+            if diversions[path] != (divert, package):
+                exit(f'Diversion of "{path}" clashes with existing diversion to "{diversions[path][0]}"!')
+            continue
+        if lexists(path) and lexists(divert):
+            exit(f'Cannot divert "{path}", "{divert}" already exists!')
+
+        diversions[path] = (divert, package)
+        if lexists(path):
+            renames.append((path, divert))
+
+    return renames
+
+
+def remove(diversions, package, paths):
+    renames = []
+
+    for path in paths:
+        divert = path + '.ucf-dist'
+
+        if diversions.get(path) != (divert, package):
+            continue
+
+        del diversions[path]
+        if lexists(divert) and not lexists(path):
+            renames.append((divert, path))
+
+    return renames
+
+
+if __name__ == '__main__':
+    _, action = argv
+    package = environ.get('DPKG_MAINTSCRIPT_PACKAGE', ':')
+    paths = [line.strip() for line in stdin if line.strip()]
+
+    diversions = read_diversions()
+    original = dict(diversions)
+    renames = {'add': add, 'remove': remove}[action](diversions, package, paths)
+
+    # update the database once, then move the files
+    if diversions != original:
+        write_diversions(diversions)
+    for source, target in renames:
+        rename(source, target)
+
+    print(f'Processed {len(paths)} diversions, {len(renames)} files renamed.')
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser
+from json import load
+from hashlib import sha256
+from os import readlink, walk
+from os.path import dirname, islink, join, relpath
+from subprocess import run, PIPE, DEVNULL
+from concurrent.futures import ThreadPoolExecutor
+from syslog import openlog, syslog
+from time import monotonic
+
+LABEL = 'reversible.context'
+
+
+def inspect(kind, name, template):
+    result = run(('docker', kind, 'inspect', '--format', template, name), stdout=PIPE, stderr=DEVNULL, text=True)
+    return result.stdout.strip() if result.returncode == 0 else None
+
+
+def base_images(dockerfile, pull):
+    stages = set()
+    images = []
+
+    with open(dockerfile, 'r') as fp:
+        for line in fp:
+            words = [word for word in line.split() if not word.startswith('--')]
+            if len(words) < 2 or words[0].upper() != 'FROM':
+                continue
+            if len(words) >= 4 and words[2].upper() == 'AS':
+                stages.add(words[3])
+            if words[1] in stages or words[1] == 'scratch' or '$' in words[1]:
+                images.append(words[1])
+                continue
+            if pull or inspect('image', words[1], '{{.Id}}') is None:
+                run(('docker', 'pull', '--quiet', words[1]), stdout=DEVNULL)
+            images.append(words[1] + '@' + str(inspect('image', words[1], '{{.Id}}')))
+
+    return images
+
+
+def context_hash(spec, pull):
+    digest = sha256()
+    context = dirname(spec['dockerfile'])
+
+    digest.update(spec['dockerfile'].encode() + b'\0')
+    for key, value in sorted(spec['arguments'].items()):
+        digest.update(f'{key}={value}'.encode() + b'\0')
+    for image in base_images(spec['dockerfile'], pull):
+        digest.update(image.encode() + b'\0')
+
+    for root, dirs, files in walk(context):
+        dirs.sort()
+        for name in sorted(files):
+            path = join(root, name)
+            digest.update(relpath(path, context).encode() + b'\0')
+            if islink(path):
+                digest.update(readlink(path).encode() + b'\0')
+                continue
+            with open(path, 'rb') as fp:
+                for chunk in iter(lambda: fp.read(1048576), b''):
+                    digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def prepare(spec, pull=False):
+    image = spec['image']
+
+    if spec['dockerfile'] is None:
+        if not pull and inspect('image', image, '{{.Id}}') is not None:
+            return image, 'present', 0
+        return image, 'pulled', run(('docker', 'pull', '--quiet', image), stdout=DEVNULL).returncode
+
+    digest = context_hash(spec, pull)
+    if inspect('image', image, '{{index .Config.Labels "' + LABEL + '"}}') == digest:
+        return image, 'unchanged', 0
+
+    command = ['docker', 'build', '--quiet', '--tag', image, '--file', spec['dockerfile'], '--label', f'{LABEL}={digest}']
+    for key, value in spec['arguments'].items():
+        command += ['--build-arg', f'{key}={value}']
+    command.append(dirname(spec['dockerfile']))
+
+    return image, 'built', run(command, stdout=DEVNULL).returncode
+
+
+def rebuild(spec, name):
+    container = spec['containers'][name]
+    image = next(image for image in spec['images'] if image['image'] == container['image'])
+    start = monotonic()
+
+    # refresh the image, then only recreate when the container runs something else
+    _, action, code = prepare(image, pull=True)
+    if code:
+        result = 'failed'
+    elif inspect('container', name, '{{.Image}}') == inspect('image', image['image'], '{{.Id}}'):
+        result = 'unchanged'
+    else:
+        for command in container['remove']:
+            run(('/bin/bash', '-c', command))
+        result = 'recreated'
+        for command in container['setup']:
+            if run(('/bin/bash', '-c', command)).returncode:
+                result = 'failed'
+
+    message = f'metric=docker-rebuild container={name} image={image["image"]} action={action} result={result} duration={monotonic() - start:.3f}'
+    openlog('reversible')
+    syslog(message)
+    print(message)
+
+    return result != 'failed'
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Build or pull the Docker images of a package in parallel.')
+    parser.add_argument('spec', help='image specification written by the package')
+    parser.add_argument('images', nargs='*', help='only prepare these images')
+    parser.add_argument('--rebuild', metavar='CONTAINER', help='refresh the image of a container and recreate it when changed')
+    args = parser.parse_args()
+
+    with open(args.spec, 'r') as fp:
+        spec = load(fp)
+
+    if args.rebuild is not None:
+        exit(0 if rebuild(spec, args.rebuild) else 1)
+
+    images = {image['image']: image for image in spec['images'] if not args.images or image['image'] in args.images}
+    with ThreadPoolExecutor(spec['jobs']) as pool:
+        results = list(pool.map(prepare, images.values()))
+
+    for image, action, code in results:
+        print(f'{image}: {action}' + (f' (failed with exit code {code})' if code else ''))
+    if any(code for _, _, code in results):
+        exit(1)
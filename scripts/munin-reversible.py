@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+from json import dump, load
+from os import environ
+from os.path import join
+from re import sub
+from subprocess import run, PIPE
+from sys import argv
+
+STATE = join(environ.get('MUNIN_PLUGSTATE', '/var/lib/munin-node/plugin-state/nobody'), 'reversible.json')
+
+GRAPHS = {
+    'reversible_install': ('Package install duration', 'seconds'),
+    'reversible_snippets': ('Maintainer script time per package', 'seconds'),
+    'reversible_repo_duration': ('Managed repo update duration', 'seconds'),
+    'reversible_repo_results': ('Managed repo update outcomes', 'updates'),
+    'reversible_docker': ('Docker rebuild duration', 'seconds'),
+    'reversible_upgrades': ('Packages upgraded', 'packages'),
+}
+
+
+def fieldname(label):
+    name = sub(r'[^A-Za-z0-9_]', '_', label)
+    return '_' + name if name[:1].isdigit() or not name else name
+
+
+def samples(fields):
+    # every metric line maps to the graphs it feeds, how values add up within an interval follows the graph
+    metric = fields.get('metric')
+    duration = float(fields.get('duration', 0))
+
+    if metric == 'package-install':
+        yield 'reversible_install', fields.get('package', '-'), duration, False
+    elif metric == 'maintainer-snippet':
+        yield 'reversible_snippets', fields.get('package', '-'), duration, True
+    elif metric == 'repo-update':
+        yield 'reversible_repo_duration', fields.get('path', '-'), duration, False
+        yield 'reversible_repo_results', fields.get('result', '-'), 1, True
+    elif metric == 'docker-rebuild':
+        yield 'reversible_docker', fields.get('container', '-'), duration, False
+    elif metric == 'package-upgrade':
+        yield 'reversible_upgrades', fields.get('manager', '-'), int(fields.get('upgraded', 0)), True
+
+
+def update(state):
+    command = ['journalctl', '--quiet', '--no-pager', '--output=cat', '--show-cursor', '--identifier=reversible']
+    command += [f'--after-cursor={state["cursor"]}'] if state.get('cursor') else ['--since=-5min']
+    lines = run(command, stdout=PIPE, text=True).stdout.splitlines()
+
+    for line in lines:
+        if line.startswith('-- cursor: '):
+            state['cursor'] = line[11:]
+            continue
+
+        fields = dict(field.split('=', 1) for field in line.split() if '=' in field)
+        for graph, label, value, additive in samples(fields):
+            field = fieldname(label)
+            state['fields'].setdefault(graph, {})[field] = label
+
+            pending = state['pending'].setdefault(graph, {})
+            pending[field] = pending.get(field, 0) + value if additive else value
+
+
+def config(state):
+    for graph, (title, vlabel) in GRAPHS.items():
+        print(f'multigraph {graph}')
+        print(f'graph_title {title}')
+        print(f'graph_vlabel {vlabel}')
+        print('graph_category reversible')
+        print('graph_args --lower-limit 0')
+        for field, label in sorted(state['fields'].get(graph, {}).items()):
+            print(f'{field}.label {label}')
+            print(f'{field}.type GAUGE')
+            print(f'{field}.min 0')
+
+
+def fetch(state):
+    # values only exist for the interval they happened in, quiet fields report unknown
+    for graph in GRAPHS:
+        print(f'multigraph {graph}')
+        pending = state['pending'].get(graph, {})
+        for field in sorted(state['fields'].get(graph, {})):
+            print(f'{field}.value {pending.get(field, "U")}')
+
+    state['pending'] = {}
+
+
+if __name__ == '__main__':
+    if argv[1:] == ['autoconf']:
+        print('yes')
+        exit(0)
+
+    try:
+        with open(STATE, 'r') as fp:
+            state = load(fp)
+    except (OSError, ValueError):
+        state = {'cursor': None, 'fields': {}, 'pending': {}}
+
+    # config and fetch both read ahead, so new fields are configured before their first value
+    update(state)
+    if argv[1:] == ['config']:
+        config(state)
+    else:
+        fetch(state)
+
+    with open(STATE, 'w') as fp:
+        dump(state, fp)
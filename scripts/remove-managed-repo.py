@@ -1,35 +1,22 @@
 #!/usr/bin/env python3
 
 from sys import argv
-from subprocess import run
-from os import unlink, rmdir, listdir
-from os.path import isfile, join, islink, isdir
+from subprocess import run, PIPE, DEVNULL
+from os import unlink, rmdir
+from os.path import dirname, isdir, isfile, islink, join, normpath
 from shutil import rmtree
 
-run(('pip', 'install', '--upgrade', 'gitpython'))
-from git import Repo, InvalidGitRepositoryError
 
+def git(path, *args):
+    result = run(('git', '-c', 'safe.directory=*', '-C', path, *args), stdout=PIPE, stderr=DEVNULL)
+    return [item.decode() for item in result.stdout.split(b'\0') if item] if result.returncode == 0 else None
 
-def recursive_tree_delete(node):
-    if node.type == 'tree':
-        for child in node:
-            recursive_tree_delete(child)
-        if not listdir(node.abspath):
-            rmdir(node.abspath)
-    elif islink(node.abspath) or isfile(node.abspath):
-        unlink(node.abspath)
 
-
-def recursive_module_delete(module):
-    for submodule in module.submodules:
-        recursive_module_delete(Repo(submodule.abspath))
-
-    if module.refs:
-        recursive_tree_delete(module.head.commit.tree)
-
-    rmtree(module.git_dir)
-    if isfile(join(module.working_dir, '.git')):
-        unlink(join(module.working_dir, '.git'))
+def remove_git_dir(path):
+    if islink(path) or isfile(path):
+        unlink(path)
+    elif isdir(path):
+        rmtree(path)
 
 
 def try_remove_repo(path):
@@ -37,15 +24,40 @@ def try_remove_repo(path):
         print(f'Skipping non-existing Git repository at "{path}"!')
         return
 
-    try:
-        recursive_module_delete(Repo(path))
-    except InvalidGitRepositoryError:
+    files = git(path, 'ls-files', '-z', '--recurse-submodules')
+    if files is None:
         print(f'Skipping invalid Git repository at "{path}"!')
-
-    if not listdir(path):
-        rmdir(path)
+        return
+    submodules = git(path, 'submodule', '--quiet', 'foreach', '--recursive', 'printf "%s\\0" "$displaypath"') or []
+
+    # remove all tracked files in one go, remembering their folders
+    folders = {path}
+    for file in files:
+        file = join(path, file)
+        if islink(file) or isfile(file):
+            unlink(file)
+        while file != path:
+            file = dirname(file)
+            folders.add(file)
+
+    # drop the metadata of submodules first, then of the repo itself
+    for submodule in sorted(submodules, key=len, reverse=True):
+        remove_git_dir(join(path, submodule, '.git'))
+        folders.add(normpath(join(path, submodule)))
+    remove_git_dir(join(path, '.git'))
+
+    # prune the folders that are now empty, deepest first
+    removed = 0
+    for folder in sorted(folders, key=lambda folder: folder.count('/'), reverse=True):
+        try:
+            rmdir(folder)
+            removed += 1
+        except OSError:
+            pass
+
+    print(f'Removed {len(files)} files and {removed} folders from "{path}".')
 
 
 if __name__ == '__main__':
-    _, target = argv
-    try_remove_repo(target)
+    for target in argv[1:]:
+        try_remove_repo(normpath(target))
@@ -1,36 +1,50 @@
 #!/usr/bin/env python3
 
+from os import getcwd
 from os.path import isfile
-from subprocess import run
+from subprocess import run, PIPE
+from syslog import openlog, syslog
+from time import monotonic
 
-run(('pip', 'install', '--upgrade', 'gitpython'))
-from git import Repo
+
+def git(*args):
+    return run(('git', *args), stdout=PIPE, text=True).stdout.strip()
 
 
 def run_extra_script(at):
     if isfile(at):
         result = run(at)
         if result.returncode != 0:
+            report('failed')
             exit(result.returncode)
 
 
+def report(result):
+    message = f'metric=repo-update path={getcwd()} result={result} duration={monotonic() - start:.3f}'
+    openlog('reversible')
+    syslog(message)
+    print(message)
+
+
 if __name__ == '__main__':
-    # open and prepare repo
-    repo = Repo()
-    repo.git.fetch()
+    start = monotonic()
+    branch = git('symbolic-ref', '--quiet', '--short', 'HEAD')
 
-    # exit if no pull required
+    # exit if no pull required, asking the remote for the tracked ref only
     if isfile('.git/scramjet-setup-complete') and (
-            repo.head.is_detached or repo.head.commit == repo.remotes.origin.refs[repo.active_branch.name].commit
+            not branch or git('rev-parse', 'HEAD') == git('ls-remote', 'origin', f'refs/heads/{branch}').split('\t')[0]
     ):
         print('Repo already at latest version, exiting...')
+        report('unchanged')
         exit(0)
 
     # pull repo and run extra scripts
     run_extra_script('.git/hooks/pre-pull')
-    if not repo.head.is_detached:
-        repo.git.pull('--recurse-submodules')
+    if branch and run(('git', 'pull', '--recurse-submodules')).returncode != 0:
+        report('failed')
+        exit(1)
     run_extra_script('.git/hooks/post-pull')
 
     # mark repo as updated
     open('.git/scramjet-setup-complete', 'w').close()
+    report('updated')
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser
+from json import loads
+from os import environ
+from os.path import exists, join
+from re import split, sub
+from subprocess import run, PIPE, DEVNULL
+from syslog import openlog, syslog
+from time import monotonic
+
+
+def normalise(name):
+    return sub(r'[-_.]+', '-', split(r'[\[<>=!~;@ ]', name.strip())[0]).lower()
+
+
+def npm_name(name):
+    # npm names are compared as written, only a version after a non-leading @ is dropped
+    name = name.strip()
+    return name[:name.index('@', 1)] if '@' in name[1:] else name
+
+
+def pip_outdated(pip, items):
+    installed = {
+        normalise(package['name']): package['version']
+        for package in loads(run((pip, 'list', '--format=json'), stdout=PIPE, check=True).stdout)
+    }
+    outdated = []
+
+    for item in items:
+        name = normalise(item)
+        if name not in installed:
+            outdated.append(item)
+            continue
+
+        # ask the index for this package only instead of resolving everything
+        result = run((pip, 'index', 'versions', name), stdout=PIPE, stderr=DEVNULL, text=True)
+        latest = result.stdout.partition('(')[2].partition(')')[0]
+        if result.returncode != 0 or latest != installed[name]:
+            outdated.append(item)
+
+    return outdated
+
+
+def pip_upgrade(items, venv, cache):
+    environ['PIP_CACHE_DIR'] = join(cache, 'pip')
+
+    if venv is not None:
+        if not exists(join(venv, 'bin', 'pip')):
+            run(('/usr/bin/python3', '-m', 'venv', venv), check=True)
+        pip = join(venv, 'bin', 'pip')
+    else:
+        pip = '/usr/bin/pip3'
+
+    outdated = pip_outdated(pip, items)
+    if outdated:
+        run((pip, 'install', '--upgrade', *outdated), check=True)
+
+    return outdated
+
+
+def npm_upgrade(items, cache):
+    environ['npm_config_cache'] = join(cache, 'npm')
+
+    listing = loads(run(('npm', 'ls', '--global', '--json', '--depth=0'), stdout=PIPE).stdout or '{}')
+    installed = set(listing.get('dependencies', {}))
+    names = [npm_name(item) for item in items]
+
+    # npm outdated exits non-zero when it finds something, only its output matters
+    report = loads(run(('npm', 'outdated', '--global', '--json', *names), stdout=PIPE).stdout or '{}')
+    outdated = [
+        name for name in names
+        if name not in installed or (name in report and report[name].get('current') != report[name].get('latest'))
+    ]
+
+    if outdated:
+        run(('npm', 'install', '--global', '--production', *[name + '@latest' for name in outdated]), check=True)
+
+    return outdated
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Upgrade the Python and Node packages of a package when newer versions exist.')
+    parser.add_argument('--pip', nargs='*', default=[], help='Python packages to keep up to date')
+    parser.add_argument('--npm', nargs='*', default=[], help='Node packages to keep up to date')
+    parser.add_argument('--venv', help='install the Python packages into this virtualenv')
+    parser.add_argument('--cache', default='/var/cache/reversible', help='directory for the shared download caches')
+    args = parser.parse_args()
+
+    openlog('reversible')
+    failed = False
+
+    for manager, items, upgrade in (
+            ('pip', args.pip, lambda: pip_upgrade(args.pip, args.venv, args.cache)),
+            ('npm', args.npm, lambda: npm_upgrade(args.npm, args.cache)),
+    ):
+        if not items:
+            continue
+
+        start = monotonic()
+        try:
+            upgraded, result = upgrade(), 'success'
+        except Exception as e:
+            print(f'Upgrading {manager} packages failed: {e}')
+            upgraded, result, failed = [], 'failed', True
+
+        message = (
+            f'metric=package-upgrade manager={manager} checked={len(items)} upgraded={len(upgraded)} '
+            f'packages={",".join(upgraded) or "-"} result={result} duration={monotonic() - start:.3f}'
+        )
+        syslog(message)
+        print(message)
+
+    if failed:
+        exit(1)
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser
+from json import dump, load
+from glob import glob
+from os import makedirs
+from os.path import dirname, exists, join
+from time import monotonic, time
+from socket import socket, AF_INET, SOCK_DGRAM, SOL_SOCKET, SO_REUSEADDR, timeout as Timeout
+from urllib.parse import urljoin, urlparse
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError, URLError
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+from fcntl import flock, LOCK_EX, LOCK_NB
+from syslog import openlog, syslog
+
+DEVICE = 'urn:schemas-upnp-org:device:InternetGatewayDevice:1'
+SERVICES = (
+    'urn:schemas-upnp-org:service:WANIPConnection:2',
+    'urn:schemas-upnp-org:service:WANIPConnection:1',
+    'urn:schemas-upnp-org:service:WANPPPConnection:1',
+)
+DESCRIPTION = 'reversible'
+LISTING = {'NewDescription': 'NewPortMappingDescription', 'NewLeaseTime': 'NewLeaseDuration'}
+
+
+class SoapFault(Exception):
+    pass
+
+
+class Gateway:
+    def __init__(self, control, service):
+        self.control = control
+        self.service = service
+
+    def call(self, action, **arguments):
+        body = (
+            '<?xml version="1.0"?>'
+            '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" '
+            's:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body>'
+            f'<u:{action} xmlns:u="{self.service}">'
+            + ''.join(f'<{key}>{escape(str(value))}</{key}>' for key, value in arguments.items()) +
+            f'</u:{action}></s:Body></s:Envelope>'
+        )
+        request = Request(self.control, data=body.encode('UTF8'), method='POST', headers={
+            'Content-Type': 'text/xml; charset="utf-8"',
+            'SOAPAction': f'"{self.service}#{action}"',
+        })
+
+        try:
+            with urlopen(request, timeout=10) as response:
+                tree = ElementTree.fromstring(response.read())
+        except HTTPError as e:
+            code = ElementTree.fromstring(e.read()).find('.//{*}errorCode')
+            raise SoapFault(int(code.text) if code is not None else e.code)
+
+        return {element.tag.split('}')[-1]: element.text for element in tree.find('.//{*}' + action + 'Response')}
+
+    def mappings(self):
+        mappings = {}
+
+        # ask for the full list at once where the gateway supports it
+        if self.service.endswith(':2'):
+            try:
+                listing = self.call(
+                    'GetListOfPortMappings', NewStartPort=1, NewEndPort=65535,
+                    NewProtocol='', NewManage=1, NewNumberOfPorts=65535,
+                )['NewPortListing']
+                # the listing names two fields differently than the single entries do
+                for entry in ElementTree.fromstring(listing):
+                    entry = {element.tag.split('}')[-1]: element.text for element in entry}
+                    entry = {LISTING.get(key, key): value for key, value in entry.items()}
+                    mappings[int(entry['NewExternalPort']), entry['NewProtocol']] = entry
+                return mappings
+            except (SoapFault, ElementTree.ParseError, TypeError):
+                pass
+
+        for index in range(65536):
+            try:
+                entry = self.call('GetGenericPortMappingEntry', NewPortMappingIndex=index)
+            except SoapFault:
+                break
+            mappings[int(entry['NewExternalPort']), entry['NewProtocol']] = entry
+
+        return mappings
+
+    def add(self, port, protocol, address, lease):
+        self.call(
+            'AddPortMapping', NewRemoteHost='', NewExternalPort=port, NewProtocol=protocol,
+            NewInternalPort=port, NewInternalClient=address, NewEnabled=1,
+            NewPortMappingDescription=DESCRIPTION, NewLeaseDuration=lease,
+        )
+
+    def delete(self, port, protocol):
+        self.call('DeletePortMapping', NewRemoteHost='', NewExternalPort=port, NewProtocol=protocol)
+
+
+def discover(port, wait):
+    with socket(AF_INET, SOCK_DGRAM) as sock:
+        sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        sock.bind(('', port))
+        sock.settimeout(wait)
+        sock.sendto((
+            'M-SEARCH * HTTP/1.1\r\n'
+            'HOST: 239.255.255.250:1900\r\n'
+            'MAN: "ssdp:discover"\r\n'
+            'MX: 2\r\n'
+            f'ST: {DEVICE}\r\n\r\n'
+        ).encode('ASCII'), ('239.255.255.250', 1900))
+
+        try:
+            while True:
+                response = sock.recv(65536).decode('ASCII', 'replace')
+                for line in response.split('\r\n'):
+                    if line.lower().startswith('location:'):
+                        return line.split(':', 1)[1].strip()
+        except Timeout:
+            return None
+
+
+def describe(location):
+    with urlopen(location, timeout=10) as response:
+        tree = ElementTree.fromstring(response.read())
+
+    base = tree.findtext('{*}URLBase') or location
+    for service in SERVICES:
+        for element in tree.iter('{urn:schemas-upnp-org:device-1-0}service'):
+            if element.findtext('{*}serviceType') == service:
+                return {
+                    'location': location,
+                    'control': urljoin(base, element.findtext('{*}controlURL')),
+                    'service': service,
+                }
+
+    return None
+
+
+def local_address(control):
+    with socket(AF_INET, SOCK_DGRAM) as sock:
+        sock.connect((urlparse(control).hostname, 1900))
+        return sock.getsockname()[0]
+
+
+def desired_mappings(directory, control):
+    desired = {}
+
+    for path in sorted(glob(join(directory, '*.json'))):
+        with open(path, 'r') as fp:
+            config = load(fp)
+        address = config.get('address') or local_address(control)
+        for port in config['ports']:
+            for protocol in ('TCP', 'UDP'):
+                desired[int(port), protocol] = address
+
+    return desired
+
+
+def synchronise(gateway, desired, lease, margin):
+    added, kept, removed, failed = 0, 0, 0, 0
+    existing = gateway.mappings()
+
+    for (port, protocol), address in desired.items():
+        entry = existing.get((port, protocol))
+        if entry is not None and entry['NewInternalClient'] == address and entry['NewEnabled'] in {'1', 'true'}:
+            remaining = int(entry.get('NewLeaseDuration') or 0)
+            if remaining == 0 or remaining > margin:
+                kept += 1
+                continue
+
+        # a refused mapping, like a port held by another client, leaves the others alone
+        try:
+            if entry is not None and entry['NewPortMappingDescription'] == DESCRIPTION:
+                gateway.delete(port, protocol)
+            gateway.add(port, protocol, address, lease)
+            added += 1
+        except SoapFault as e:
+            print(f'Mapping {protocol} port {port} to "{address}" failed with error {e}')
+            failed += 1
+
+    for (port, protocol), entry in existing.items():
+        if (port, protocol) not in desired and entry['NewPortMappingDescription'] == DESCRIPTION:
+            try:
+                gateway.delete(port, protocol)
+                removed += 1
+            except SoapFault as e:
+                print(f'Unmapping {protocol} port {port} failed with error {e}')
+                failed += 1
+
+    return added, kept, removed, failed
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Keep UPnP port mappings for all packages in place.')
+    parser.add_argument('--ports', default='/etc/upnp/ports/', help='directory with per-package port files')
+    parser.add_argument('--cache', default='/var/cache/reversible/upnp.json', help='file remembering the gateway')
+    parser.add_argument('--ssdp-port', type=int, default=1900, help='local port for gateway discovery')
+    parser.add_argument('--lease', type=int, default=3600, help='lease duration of new mappings in seconds')
+    parser.add_argument('--margin', type=int, default=1800, help='refresh mappings expiring within this many seconds')
+    parser.add_argument('--interval', type=int, default=0, help='skip when the last run was this many seconds ago')
+    parser.add_argument('--location', help='gateway description URL, skipping discovery')
+    args = parser.parse_args()
+
+    # run once at a time, and not more often than asked
+    makedirs(dirname(args.cache), exist_ok=True)
+    lock = open(args.cache + '.lock', 'w')
+    try:
+        flock(lock, LOCK_EX | LOCK_NB)
+    except BlockingIOError:
+        exit(0)
+
+    cached = {}
+    if exists(args.cache):
+        with open(args.cache, 'r') as fp:
+            cached = load(fp)
+    if time() - cached.get('synchronised', 0) < args.interval:
+        exit(0)
+
+    start = monotonic()
+    result = None
+
+    for attempt in ('cached', 'discovered'):
+        if attempt == 'cached' and 'control' not in cached:
+            continue
+        if attempt == 'discovered':
+            location = args.location or discover(args.ssdp_port, 3)
+            cached = describe(location) if location else None
+            if cached is None:
+                exit('No Internet Gateway Device found!')
+
+        try:
+            gateway = Gateway(cached['control'], cached['service'])
+            result = synchronise(gateway, desired_mappings(args.ports, cached['control']), args.lease, args.margin)
+            break
+        except (URLError, OSError, SoapFault) as e:
+            print(f'Gateway at "{cached["control"]}" failed: {e}')
+
+    if result is None:
+        exit(1)
+
+    cached['synchronised'] = time()
+    with open(args.cache, 'w') as fp:
+        dump(cached, fp, indent=2)
+
+    message = (
+        f'metric=upnp-sync added={result[0]} kept={result[1]} removed={result[2]} failed={result[3]} '
+        f'duration={monotonic() - start:.3f}'
+    )
+    openlog('reversible')
+    syslog(message)
+    print(message)